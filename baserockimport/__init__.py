@@ -17,9 +17,14 @@
 '''Baserock library for importing metadata from foreign packaging systems.'''
 
 
+import buildorder
+import extensionworkers
+import gitmirror
 import lorryset
 import morphsetondisk
 import package
+import profiler
+import resultcache
 
 import app
 import mainloop
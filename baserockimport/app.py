@@ -16,6 +16,7 @@
 
 import ansicolor
 import cliapp
+import yaml
 
 import logging
 import os
@@ -43,6 +44,23 @@ class BaserockImportApplication(cliapp.Application):
                              "Lorry working directory",
                              metavar="PATH",
                              default=os.path.abspath('./lorry-working-dir'))
+        self.settings.string(['cache-dir'],
+                             "location for cached metadata, shared between "
+                             "imports",
+                             metavar="PATH",
+                             default=os.path.abspath('./cache'))
+        self.settings.boolean(['result-cache'],
+                              "reuse output that import extensions produced "
+                              "for the same source commit in earlier imports, "
+                              "where it depends on nothing else (see README)",
+                              default=True)
+        self.settings.string(['result-cache-dir'],
+                             "location for the result cache, which can be "
+                             "shared between imports and machines, or an "
+                             "empty string to use the 'results' directory "
+                             "in the cache directory",
+                             metavar="PATH",
+                             default='')
 
         self.settings.boolean(['force-stratum-generation', 'force-stratum'],
                               "always create a stratum, overwriting any "
@@ -53,6 +71,13 @@ class BaserockImportApplication(cliapp.Application):
                               "update all the checked-out Git trees and "
                               "generated definitions",
                               default=False)
+        self.settings.boolean(['incremental'],
+                              "update an existing stratum morphology: "
+                              "chunks whose version and commit haven't "
+                              "changed are not fetched or analysed again, "
+                              "and the order of the chunks is kept where it "
+                              "is still valid",
+                              default=False)
         self.settings.boolean(['use-local-sources'],
                               "use file:/// URLs in the stratum 'repo' "
                               "fields, instead of upstream: URLs",
@@ -63,6 +88,92 @@ class BaserockImportApplication(cliapp.Application):
                               "error",
                               default=False)
 
+        self.settings.integer(['jobs', 'j'],
+                              "number of packages to process concurrently; "
+                              "the source of each package is fetched and "
+                              "then analysed, and packages at each of these "
+                              "stages are independent of each other",
+                              metavar="N",
+                              default=1)
+        self.settings.integer(['fetch-jobs'],
+                              "number of packages whose source is fetched "
+                              "concurrently, or 0 to use the value of --jobs",
+                              metavar="N",
+                              default=0)
+        self.settings.integer(['analysis-jobs'],
+                              "number of packages that import extensions "
+                              "analyse concurrently, or 0 to use the value "
+                              "of --jobs",
+                              metavar="N",
+                              default=0)
+        self.settings.integer(['pypi-cache-ttl'],
+                              "number of seconds to keep cached metadata "
+                              "from the Python Package Index for",
+                              metavar="SECONDS",
+                              default=24 * 60 * 60)
+        self.settings.integer(['rubygems-cache-ttl'],
+                              "number of seconds to keep cached metadata "
+                              "from rubygems.org for",
+                              metavar="SECONDS",
+                              default=24 * 60 * 60)
+        self.settings.string(['pypi-index'],
+                             "work offline, using a local JSON index of "
+                             "Python packages instead of the Python Package "
+                             "Index (see README.python)",
+                             metavar="PATH",
+                             default='')
+        self.settings.choice(['python-resolution'],
+                             ['per-package', 'import-wide'],
+                             "how to choose versions of Python packages: "
+                             "'per-package' picks the newest version that "
+                             "satisfies each package's own requirements, "
+                             "'import-wide' picks one version of each project "
+                             "that satisfies every package in the import",
+                             metavar="MODE")
+        self.settings.boolean(['persistent-extensions'],
+                              "keep import extensions that support it "
+                              "running as worker processes, instead of "
+                              "starting them again for every package",
+                              default=True)
+        self.settings.integer(['checkpoint-interval'],
+                              "save new lorry entries and the state of the "
+                              "import to disk every SECONDS seconds during "
+                              "an import, as well as when it ends or is "
+                              "interrupted",
+                              metavar="SECONDS",
+                              default=60)
+        self.settings.choice(['checkout-mode'],
+                             ['clone', 'worktree'],
+                             "how to check out source code: 'clone' makes "
+                             "a clone of each Lorry mirror in checkouts-dir, "
+                             "'worktree' adds a Git worktree for each "
+                             "version instead, which shares the objects of "
+                             "the mirror (needs Git 2.5 or later)",
+                             metavar="MODE")
+        self.settings.integer(['fetch-max-age'],
+                              "don't update the checkout of a source repo "
+                              "that already contains the wanted ref if it "
+                              "was last updated less than SECONDS seconds "
+                              "ago",
+                              metavar="SECONDS",
+                              default=24 * 60 * 60)
+        self.settings.boolean(['resume'],
+                              "continue an import of the same package from "
+                              "where the last run stopped, without processing "
+                              "the packages it completed again",
+                              default=False)
+        self.settings.string(['profile-dir'],
+                             "record how long each phase of processing each "
+                             "package takes, and write a JSON report and a "
+                             "Chrome trace-event file to DIR",
+                             metavar="DIR",
+                             default='')
+        self.settings.integer(['profile-top'],
+                              "list the N slowest packages and phases when "
+                              "profiling",
+                              metavar="N",
+                              default=10)
+
     def _stream_has_colours(self, stream):
         # http://blog.mathieu-leplatre.info/colored-output-in-console-with-python.html
         if not hasattr(stream, "isatty"):
@@ -84,6 +195,8 @@ class BaserockImportApplication(cliapp.Application):
                             arg_synopsis='GEM_NAME [GEM_VERSION]')
         self.add_subcommand('python', self.import_python,
                             arg_synopsis='PACKAGE_NAME [VERSION]')
+        self.add_subcommand('batch', self.import_batch,
+                            arg_synopsis='MANIFEST')
 
         self.stdout_has_colours = self._stream_has_colours(sys.stdout)
 
@@ -165,9 +278,13 @@ class BaserockImportApplication(cliapp.Application):
         loop = baserockimport.mainloop.ImportLoop(
             app=self,
             goal_kind='omnibus', goal_name=args[2], goal_version='master')
+        # The software definitions come from the definitions repo and from
+        # the Gems that Bundler chose for it, which the result cache can't
+        # tell have changed.
         loop.enable_importer('omnibus',
-                             extra_args=[definitions_dir, project_name])
-        loop.enable_importer('rubygems')
+                             extra_args=[definitions_dir, project_name],
+                             cache_results=False)
+        loop.enable_importer('rubygems', prefetch_lorries=True)
         loop.run()
 
     def import_rubygems(self, args):
@@ -183,7 +300,7 @@ class BaserockImportApplication(cliapp.Application):
         loop = baserockimport.mainloop.ImportLoop(
             app=self,
             goal_kind='rubygems', goal_name=args[0], goal_version=goal_version)
-        loop.enable_importer('rubygems', strata=['strata/ruby.morph'])
+        self._enable_importer(loop, 'rubygems')
         loop.run()
 
     def import_python(self, args):
@@ -200,5 +317,81 @@ class BaserockImportApplication(cliapp.Application):
                                                   goal_kind='python',
                                                   goal_name=package_name,
                                                   goal_version=package_version)
-        loop.enable_importer('python', strata=['strata/core.morph'])
+        self._enable_importer(loop, 'python')
+        loop.run()
+
+    def import_batch(self, args):
+        '''Import many packages in one run, with a stratum for each.
+
+        The manifest is a YAML list of the packages to import, each with a
+        'kind' ('python' or 'rubygems'), a 'name' and optionally a 'version'
+        and the name of the 'stratum' to generate for it. Dependencies that
+        the packages share are only processed once.
+
+        '''
+        if len(args) != 1:
+            raise cliapp.AppException(
+                'Please pass the path to a manifest of the packages to '
+                'import on the commandline.')
+
+        goals = self._load_manifest(args[0])
+
+        first = goals[0]
+        loop = baserockimport.mainloop.ImportLoop(
+            app=self, goal_kind=first['kind'], goal_name=first['name'],
+            goal_version=first['version'], stratum_name=first['stratum'])
+        for goal in goals[1:]:
+            loop.add_goal(goal['kind'], goal['name'], goal['version'],
+                          goal['stratum'])
+        for kind in sorted(set(goal['kind'] for goal in goals)):
+            self._enable_importer(loop, kind)
         loop.run()
+
+    def _load_manifest(self, path):
+        with open(path) as f:
+            try:
+                manifest = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise cliapp.AppException(
+                    'Unable to parse manifest %s: %s' % (path, e))
+
+        if not isinstance(manifest, list) or len(manifest) == 0:
+            raise cliapp.AppException(
+                'Manifest %s should be a list of packages to import' % path)
+
+        goals = []
+        for i, entry in enumerate(manifest):
+            if not isinstance(entry, dict) or 'name' not in entry:
+                raise cliapp.AppException(
+                    'Entry %i of manifest %s has no package name' % (i, path))
+            kind = entry.get('kind')
+            if kind == 'omnibus':
+                # The import has to run inside the Bundler environment of the
+                # Omnibus project, so it can't be mixed with other goals.
+                raise cliapp.AppException(
+                    'Omnibus projects can\'t be imported in a batch, use the '
+                    '\'omnibus\' subcommand for %s' % entry['name'])
+            if kind not in ['python', 'rubygems']:
+                raise cliapp.AppException(
+                    'Entry %i of manifest %s has unknown kind %s' %
+                    (i, path, kind))
+            version = entry.get('version', 'master')
+            if not isinstance(version, basestring):
+                # YAML would read 1.10 as the number 1.1, for example.
+                raise cliapp.AppException(
+                    'Version %s of %s in manifest %s should be quoted' %
+                    (version, entry['name'], path))
+            goals.append({
+                'kind': kind,
+                'name': str(entry['name']),
+                'version': str(version),
+                'stratum': entry.get('stratum'),
+            })
+        return goals
+
+    def _enable_importer(self, loop, kind):
+        if kind == 'rubygems':
+            loop.enable_importer('rubygems', strata=['strata/ruby.morph'],
+                                 prefetch_lorries=True)
+        elif kind == 'python':
+            loop.enable_importer('python', strata=['strata/core.morph'])
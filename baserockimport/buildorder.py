@@ -0,0 +1,133 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Work out the order that the chunks of a stratum can be built in.
+
+The functions here take a networkx.DiGraph with an edge from each chunk to
+every chunk that build-depends on it, like the graph that ImportLoop builds.
+
+'''
+
+
+import cliapp
+import networkx
+
+import heapq
+
+
+class BuildCycleError(cliapp.AppException):
+    '''Some chunks build-depend on each other, so they can't be ordered.
+
+    'cycles' is a list of the edges that make up each group of chunks that
+    are in a cycle, as (dependency, dependent) pairs of labels.
+
+    '''
+
+    def __init__(self, cycles):
+        self.cycles = cycles
+        descriptions = [', '.join('%s -> %s' % edge for edge in edges)
+                        for edges in cycles]
+        cliapp.AppException.__init__(
+            self, 'One or more cycles detected in build graph: %s' %
+            '; '.join(descriptions))
+
+
+def find_cycles(graph, label=str):
+    '''Return the edges of every cycle in 'graph'.
+
+    Each group of nodes that are all reachable from each other is one item
+    in the result, which lists the edges between them as pairs of labels.
+    This covers every cycle without listing each of the many overlapping
+    cycles that a large group can contain. The result is sorted.
+
+    '''
+    cycles = []
+    for component in networkx.strongly_connected_components(graph):
+        component = set(component)
+        if len(component) == 1:
+            node = next(iter(component))
+            if not graph.has_edge(node, node):
+                continue
+        edges = sorted(
+            (label(node), label(dependent))
+            for node in component
+            for dependent in graph.successors(node)
+            if dependent in component)
+        cycles.append(edges)
+    return sorted(cycles)
+
+
+def build_levels(graph, sort_key, label=str):
+    '''Group the nodes of 'graph' into levels that can be built in parallel.
+
+    Level 0 is the nodes with no build dependencies, and each later level
+    is the nodes whose build dependencies are all in earlier levels. So the
+    nodes within a level don't depend on each other, and the levels in turn
+    give a build order. Each level is sorted by 'sort_key', so the result is
+    the same every time for the same graph.
+
+    This takes one pass over the nodes and edges. If there is a cycle,
+    BuildCycleError is raised with every cycle, labelled with 'label'.
+
+    '''
+    in_degree = dict((node, graph.in_degree(node)) for node in graph.nodes())
+    level = sorted((node for node, degree in in_degree.iteritems()
+                    if degree == 0), key=sort_key)
+
+    levels = []
+    n_ordered = 0
+    while len(level) > 0:
+        levels.append(level)
+        n_ordered += len(level)
+        next_level = []
+        for node in level:
+            for dependent in graph.successors(node):
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    next_level.append(dependent)
+        level = sorted(next_level, key=sort_key)
+
+    if n_ordered < graph.number_of_nodes():
+        raise BuildCycleError(find_cycles(graph, label=label))
+    return levels
+
+
+def prioritised_order(graph, sort_key, label=str):
+    '''Return a build order for 'graph' that follows 'sort_key' if it can.
+
+    Of the nodes whose build dependencies have all been ordered, the one
+    with the lowest sort key always comes next. For example, sorting by
+    each node's position in an existing order keeps that order where it is
+    still valid. Cycles are reported as for build_levels().
+
+    '''
+    in_degree = dict((node, graph.in_degree(node)) for node in graph.nodes())
+    ready = [(sort_key(node), node)
+             for node, degree in in_degree.iteritems() if degree == 0]
+    heapq.heapify(ready)
+
+    order = []
+    while len(ready) > 0:
+        _, node = heapq.heappop(ready)
+        order.append(node)
+        for dependent in graph.successors(node):
+            in_degree[dependent] -= 1
+            if in_degree[dependent] == 0:
+                heapq.heappush(ready, (sort_key(dependent), dependent))
+
+    if len(order) < graph.number_of_nodes():
+        raise BuildCycleError(find_cycles(graph, label=label))
+    return order
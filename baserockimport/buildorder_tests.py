@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import networkx
+
+import unittest
+
+from baserockimport.buildorder import (BuildCycleError, build_levels,
+                                       find_cycles, prioritised_order)
+
+
+def make_graph(edges, nodes=()):
+    '''Return a graph with an edge from each dependency to its dependent.'''
+    graph = networkx.DiGraph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    return graph
+
+
+class BuildOrderTests(unittest.TestCase):
+
+    def test_levels(self):
+        # 'c' needs 'a' and 'b', 'd' needs 'c', and 'e' needs nothing.
+        graph = make_graph([('b', 'c'), ('a', 'c'), ('c', 'd')],
+                           nodes=['e'])
+
+        self.assertEqual(build_levels(graph, sort_key=str),
+                         [['a', 'b', 'e'], ['c'], ['d']])
+
+    def test_levels_follow_sort_key(self):
+        graph = make_graph([('a', 'c')], nodes=['b'])
+        position = {'c': 0, 'b': 1, 'a': 2}
+
+        self.assertEqual(build_levels(graph, sort_key=position.get),
+                         [['b', 'a'], ['c']])
+
+    def test_prioritised_order(self):
+        # 'a' comes as late as it can, and 'c' still has to follow it.
+        graph = make_graph([('a', 'c')], nodes=['b', 'd'])
+        position = {'d': 0, 'c': 1, 'b': 2, 'a': 3}
+
+        self.assertEqual(prioritised_order(graph, sort_key=position.get),
+                         ['d', 'b', 'a', 'c'])
+
+    def test_self_dependency(self):
+        graph = make_graph([('a', 'a'), ('a', 'b')])
+
+        self.assertEqual(find_cycles(graph), [[('a', 'a')]])
+        with self.assertRaises(BuildCycleError) as context:
+            build_levels(graph, sort_key=str)
+        self.assertEqual(context.exception.cycles, [[('a', 'a')]])
+
+    def test_disjoint_cycles(self):
+        graph = make_graph([('c', 'd'), ('d', 'c'),
+                            ('a', 'b'), ('b', 'a'), ('b', 'e'),
+                            ('x', 'y')])
+        cycles = [[('a', 'b'), ('b', 'a')], [('c', 'd'), ('d', 'c')]]
+
+        self.assertEqual(find_cycles(graph), cycles)
+        for order in (build_levels, prioritised_order):
+            with self.assertRaises(BuildCycleError) as context:
+                order(graph, sort_key=str)
+            self.assertEqual(context.exception.cycles, cycles)
+            self.assertIn('a -> b, b -> a; c -> d, d -> c',
+                          str(context.exception))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(BuildOrderTests)
+    unittest.TextTestRunner(verbosity=2).run(suite)
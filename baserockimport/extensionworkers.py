@@ -0,0 +1,208 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+
+import collections
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+
+# How long a worker has to exit once it is asked to, before it is killed.
+CLOSE_TIMEOUT = 10
+
+
+class ExtensionWorkerError(cliapp.AppException):
+    pass
+
+
+class ExtensionWorker(object):
+    '''A long-lived import extension process that serves many requests.
+
+    Starting an import extension can be expensive: the Python ones import
+    pkg_resources and friends, and the Omnibus ones start Ruby, Bundler and
+    load the whole Omnibus project. An extension that supports it can instead
+    be started once in 'worker' mode, and then be sent the commandline
+    arguments for each package in turn.
+
+    The protocol is described in ImportExtension.serve(), in
+    exts/importer_base.py.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.logger = logging.getLogger(self.name)
+
+        env = dict(os.environ)
+        env['BASEROCK_IMPORT_WORKER'] = '1'
+        # Extensions write their log messages to MORPH_LOG_FD. The worker's
+        # stderr is only used for logging, so send them there.
+        env['MORPH_LOG_FD'] = '2'
+
+        logging.debug('Starting %s as a worker process', path)
+        self.process = subprocess.Popen(
+            [path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=env, close_fds=True)
+
+        self.stderr_thread = threading.Thread(target=self._log_stderr)
+        self.stderr_thread.daemon = True
+        self.stderr_thread.start()
+
+        if self._read_message() != {'ready': True}:
+            self.close()
+            raise ExtensionWorkerError(
+                '%s does not support running as a worker' % self.name)
+
+    def _log_stderr(self):
+        for line in iter(self.process.stderr.readline, ''):
+            self.logger.debug(line.rstrip('\n'))
+
+    def _read_message(self):
+        '''Return the next message from the worker, or None at end of file.'''
+        while True:
+            line = self.process.stdout.readline()
+            if line == '':
+                return None
+            try:
+                return json.loads(line)
+            except ValueError:
+                self.logger.debug(
+                    'Ignoring unexpected output: %s', line.rstrip('\n'))
+
+    def request(self, args, report_stdout, report_stderr):
+        '''Run the extension with 'args', and return its exit code.
+
+        Each line of output is passed to the 'report_stdout' or
+        'report_stderr' callback as it arrives.
+
+        '''
+        try:
+            self.process.stdin.write(json.dumps({'args': args}) + '\n')
+            self.process.stdin.flush()
+        except IOError as e:
+            raise ExtensionWorkerError(
+                'Unable to send request to %s: %s' % (self.name, e))
+
+        while True:
+            message = self._read_message()
+            if message is None:
+                raise ExtensionWorkerError(
+                    '%s worker process exited unexpectedly' % self.name)
+            elif 'stdout' in message:
+                report_stdout(message['stdout'])
+            elif 'stderr' in message:
+                report_stderr(message['stderr'])
+            elif 'exit' in message:
+                return message['exit']
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        '''Ask the worker to exit, and wait for it to do so.
+
+        A worker that is still running after 'timeout' seconds, for example
+        because it is stuck in the middle of a request, is killed.
+
+        '''
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+
+        deadline = time.time() + timeout
+        while self.process.poll() is None:
+            if time.time() >= deadline:
+                logging.warning('%s worker process did not exit after %i '
+                                'seconds; killing it', self.name, timeout)
+                self.process.kill()
+                self.process.wait()
+                break
+            time.sleep(0.05)
+
+
+class ExtensionWorkerPool(object):
+    '''Keeps a set of idle ExtensionWorker processes for each extension.
+
+    A worker only handles one request at a time, so when packages are being
+    processed concurrently more than one worker may be started for the same
+    extension.
+
+    Extensions that don't support running as a worker are remembered, and
+    run() returns None for them so that the caller can run them the normal
+    way, once for each package.
+
+    '''
+
+    def __init__(self):
+        self.idle_workers = collections.defaultdict(list)
+        self.unsupported = set()
+        self.lock = threading.Lock()
+
+    def _acquire(self, path):
+        with self.lock:
+            if path in self.unsupported:
+                return None
+            if len(self.idle_workers[path]) > 0:
+                return self.idle_workers[path].pop()
+
+        try:
+            return ExtensionWorker(path)
+        except (ExtensionWorkerError, OSError) as e:
+            logging.info(
+                'Not using a worker process for %s: %s', path, e)
+            with self.lock:
+                self.unsupported.add(path)
+            return None
+
+    def _release(self, path, worker):
+        with self.lock:
+            self.idle_workers[path].append(worker)
+
+    def run(self, path, args, report_stdout, report_stderr):
+        '''Run an extension in a worker process, and return its exit code.
+
+        Returns None if the extension does not support running as a worker.
+
+        '''
+        worker = self._acquire(path)
+        if worker is None:
+            return None
+
+        try:
+            returncode = worker.request(args, report_stdout, report_stderr)
+        except ExtensionWorkerError as e:
+            # The request may have been partly handled, so running it again
+            # could report some output twice. Treat it as a failure of the
+            # extension instead.
+            report_stderr(str(e))
+            worker.close()
+            return 1
+
+        self._release(path, worker)
+        return returncode
+
+    def close(self):
+        '''Stop all of the idle worker processes.'''
+        with self.lock:
+            workers = [w for ws in self.idle_workers.itervalues() for w in ws]
+            self.idle_workers.clear()
+
+        for worker in workers:
+            worker.close()
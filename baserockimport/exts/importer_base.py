@@ -16,15 +16,71 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import json
 import logging
 import os
 import sys
+import traceback
 
 
 class ImportException(Exception):
     pass
 
 
+class FramedWriter(object):
+    '''File-like object that sends each line written to it as a message.
+
+    This is used when an extension is running as a worker process. See
+    ImportExtension.serve() for a description of the protocol.
+
+    '''
+
+    def __init__(self, stream, key):
+        self.stream = stream
+        self.key = key
+        self.buffer = ''
+
+    def write(self, text):
+        self.buffer += text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.send(line)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.send(self.buffer)
+            self.buffer = ''
+
+    def send(self, line):
+        send_message(self.stream, {self.key: line})
+
+
+def send_message(stream, message):
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+
+
+# Records are JSON objects that an extension writes on stdout as soon as it
+# knows them, so that the Baserock Import tool can act on them before the
+# extension finishes. Each one is written on a line of its own, preceded by
+# the ASCII record separator character, as in RFC 7464 (JSON text sequences).
+RECORD_SEPARATOR = '\x1e'
+
+
+def records_wanted():
+    '''Return True if the Baserock Import tool reads records from stdout.'''
+    return os.environ.get('BASEROCK_IMPORT_RECORDS') == '1'
+
+
+def emit_record(record):
+    sys.stdout.write(RECORD_SEPARATOR + json.dumps(record) + '\n')
+    sys.stdout.flush()
+
+
 class ImportExtension(object):
     '''A base class for import extensions.
 
@@ -70,8 +126,69 @@ class ImportExtension(object):
         return os.path.join(script_dir, '..', 'data', filename)
 
     def run(self):
+        if os.environ.get('BASEROCK_IMPORT_WORKER'):
+            self.serve()
+            return
+
         try:
             self.process_args(sys.argv[1:])
         except ImportException as e:
             sys.stderr.write('ERROR: %s\n' % e.message)
             sys.exit(1)
+
+    def serve(self):
+        '''Process many requests from the Baserock Import tool.
+
+        The Baserock Import tool sets BASEROCK_IMPORT_WORKER in the environment
+        when it wants to reuse one extension process for many packages, which
+        saves paying the startup cost of the extension each time.
+
+        Each line the import tool writes to stdin is a JSON object of the form
+        {"args": [...]}, giving the commandline arguments for one run of the
+        extension. The extension replies on stdout with one JSON object per
+        line: {"stdout": LINE} and {"stderr": LINE} for each line of output
+        and, when the request is finished, {"exit": CODE}. The first message
+        on startup is {"ready": true}.
+
+        Anything written directly to file descriptor 1, for example by a
+        subprocess, goes to stderr so that it can't break the protocol.
+
+        '''
+        protocol = os.fdopen(os.dup(1), 'w')
+        os.dup2(2, 1)
+
+        send_message(protocol, {'ready': True})
+
+        program = sys.argv[0]
+        original_dir = os.getcwd()
+        original_stdout, original_stderr = sys.stdout, sys.stderr
+
+        for line in iter(sys.stdin.readline, ''):
+            args = json.loads(line)['args']
+
+            sys.argv = [program] + args
+            sys.stdout = FramedWriter(protocol, 'stdout')
+            sys.stderr = FramedWriter(protocol, 'stderr')
+
+            try:
+                self.process_args(args)
+                returncode = 0
+            except ImportException as e:
+                sys.stderr.write('ERROR: %s\n' % e.message)
+                returncode = 1
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    returncode = e.code or 0
+                else:
+                    sys.stderr.write('%s\n' % e.code)
+                    returncode = 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                sys.stdout, sys.stderr = original_stdout, original_stderr
+                os.chdir(original_dir)
+
+            send_message(protocol, {'exit': returncode})
@@ -23,9 +23,146 @@ require 'optparse'
 require 'yaml'
 
 module Importer
+  # Looks enough like an IO object to stand in for $stdout or $stderr. Each
+  # line written to it is sent to 'stream' as a JSON message; see Base#serve.
+  class FramedWriter
+    def initialize(stream, key)
+      @stream = stream
+      @key = key
+      @buffer = ''
+    end
+
+    def write(*strings)
+      length = 0
+      strings.each do |string|
+        string = string.to_s
+        length += string.length
+        @buffer << string
+      end
+      while (index = @buffer.index("\n"))
+        send_line(@buffer.slice!(0..index).chomp)
+      end
+      length
+    end
+
+    def puts(*lines)
+      lines = [''] if lines.empty?
+      lines.flatten.each do |line|
+        line = line.to_s
+        write(line.end_with?("\n") ? line : line + "\n")
+      end
+      nil
+    end
+
+    def print(*strings)
+      write(*strings)
+      nil
+    end
+
+    def <<(string)
+      write(string)
+      self
+    end
+
+    def flush
+      send_line(@buffer) unless @buffer.empty?
+      @buffer = ''
+      self
+    end
+
+    def sync
+      true
+    end
+
+    def sync=(value)
+    end
+
+    def tty?
+      false
+    end
+
+    private
+
+    def send_line(line)
+      @stream.puts(JSON.generate(@key => line))
+    end
+  end
+
   class Base
+    # Entry point for all importers. The importer processes ARGV once, unless
+    # the baserock-import tool has asked for a worker process by setting
+    # BASEROCK_IMPORT_WORKER in the environment.
+    def main
+      if ENV['BASEROCK_IMPORT_WORKER'] and worker_mode_supported?
+        serve
+      elsif ENV['BASEROCK_IMPORT_WORKER']
+        # The tool then runs a new process for each package instead.
+        puts(JSON.generate('ready' => false))
+      else
+        run
+      end
+    end
+
     private
 
+    # Importers whose requests can't safely share one Ruby process override
+    # this to return false.
+    def worker_mode_supported?
+      true
+    end
+
+    # Forget the Bundler definition and the gemspecs that Bundler loaded for
+    # the previous request, so that they can't leak into the next one.
+    def reset_bundler
+      return unless defined?(Bundler)
+      Bundler.reset! if Bundler.respond_to?(:reset!)
+      Bundler.clear_gemspec_cache if Bundler.respond_to?(:clear_gemspec_cache)
+    end
+
+    # Process many requests from the baserock-import tool, so the cost of
+    # starting Ruby and loading libraries is paid once instead of once per
+    # package. This follows the same protocol as ImportExtension.serve() in
+    # importer_base.py: requests are {"args": [...]} lines on stdin, and the
+    # replies are {"stdout": LINE}, {"stderr": LINE} and finally
+    # {"exit": CODE} lines on stdout.
+    def serve
+      protocol = STDOUT.dup
+      protocol.sync = true
+      # Anything written straight to file descriptor 1, for example by a
+      # subprocess, goes to stderr so it can't break the protocol.
+      STDOUT.reopen(STDERR)
+
+      protocol.puts(JSON.generate('ready' => true))
+
+      original_dir = Dir.pwd
+
+      STDIN.each_line do |line|
+        ARGV.replace(JSON.parse(line)['args'])
+        reset_bundler
+        $stdout = FramedWriter.new(protocol, 'stdout')
+        $stderr = FramedWriter.new(protocol, 'stderr')
+
+        begin
+          run
+          status = 0
+        rescue SystemExit => e
+          status = e.status
+        rescue StandardError => e
+          $stderr.puts("#{e.class}: #{e.message}")
+          log.error(e.backtrace.join("\n"))
+          status = 1
+        ensure
+          $stdout.flush
+          $stderr.flush
+          $stdout = STDOUT
+          $stderr = STDERR
+          Dir.chdir(original_dir)
+        end
+
+        protocol.puts(JSON.generate('exit' => status))
+      end
+    end
+
     def create_option_parser(banner, description)
       opts = OptionParser.new
 
@@ -44,7 +181,7 @@ module Importer
 
     def error(message)
       log.error(message)
-      STDERR.puts(message)
+      $stderr.puts(message)
     end
 
     def local_data_path(file)
@@ -28,6 +28,13 @@ end
 
 module Importer
   module BundlerExtensions
+    # Evaluating a .gemspec can 'require' files from the source tree, such as
+    # lib/foo/version.rb, and Ruby won't load those again for the next
+    # version of the same Gem. So each package gets a new process.
+    def worker_mode_supported?
+      false
+    end
+
     def locate_gemspec(gem_name, path)
       target = "#{gem_name}.gemspec"
       matches = Dir["#{path}/#{Bundler::Source::Path::DEFAULT_GLOB}"].select do |filename|
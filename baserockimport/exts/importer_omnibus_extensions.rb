@@ -90,3 +90,18 @@ class Omnibus::Builder
     @manually_installed_rubygems ||= []
   end
 end
+
+module Importer
+  module OmnibusExtensions
+    # Loading an Omnibus project evaluates all of its definitions, which is
+    # slow. When running as a worker process (see Importer::Base#serve) the
+    # same project is needed for every request, so keep it once loaded. The
+    # project is looked up relative to the current directory, which should be
+    # the project directory.
+    def load_project(project_name)
+      @loaded_projects ||= {}
+      key = [Dir.pwd, project_name]
+      @loaded_projects[key] ||= Omnibus::Project.load(project_name)
+    end
+  end
+end
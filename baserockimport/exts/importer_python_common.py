@@ -17,12 +17,25 @@
 from __future__ import print_function
 
 import sys
+import bisect
 import logging
+import json
+import os
+import sqlite3
+import time
+import xmlrpclib
 
-from importer_base import ImportExtension
+import pkg_resources
+import requests
+
+from importer_base import ImportExtension, emit_record, records_wanted
 
 PYPI_URL = 'http://pypi.python.org/pypi'
 
+# Metadata fetched from the package index is kept for this many seconds, unless
+# BASEROCK_IMPORT_PYPI_CACHE_TTL says otherwise.
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
 def warn(*args, **kwargs):
     print('%s:' % sys.argv[0], *args, file=sys.stderr, **kwargs)
 
@@ -30,6 +43,10 @@ def error(*args, **kwargs):
     warn(*args, **kwargs)
     sys.exit(1)
 
+OPMAP = {'==' : lambda x, y: x == y, '!=' : lambda x, y: x != y,
+         '<=' : lambda x, y: x <= y, '>=' : lambda x, y: x >= y,
+         '<': lambda x, y: x < y, '>' : lambda x, y: x > y}
+
 def specs_satisfied(version, specs):
     def mapping_error(op):
         # We parse ops with requirements-parser, so any invalid user input
@@ -37,14 +54,10 @@ def specs_satisfied(version, specs):
         # the pip developers adding some new operation to a requirement.
         error("Invalid op in spec: %s" % op)
 
-    opmap = {'==' : lambda x, y: x == y, '!=' : lambda x, y: x != y,
-             '<=' : lambda x, y: x <= y, '>=' : lambda x, y: x >= y,
-             '<': lambda x, y: x < y, '>' : lambda x, y: x > y}
-
     def get_op_func(op):
-        return opmap[op] if op in opmap else lambda x, y: mapping_error(op)
+        return OPMAP[op] if op in OPMAP else lambda x, y: mapping_error(op)
 
-    return all([get_op_func(op)(version, sv) for (op, sv) in specs])
+    return all(get_op_func(op)(version, sv) for (op, sv) in specs)
 
 def name_or_closest(client, package_name):
     '''Packages on pypi are case insensitive,
@@ -88,6 +101,560 @@ def name_or_closest(client, package_name):
 
     return results[0]['name'] if len(results) > 0 else None
 
+def normalise_project_name(name):
+    '''Return the form of a project name used as a key in the metadata cache.
+
+    According to PEP 426, comparisons of distribution names are case
+    insensitive and consider hyphens and underscores to be equivalent.
+
+    '''
+    return name.lower().replace('_', '-')
+
+class PyPIMetadataCache(object):
+    '''Persistent store of package index metadata, in an SQLite database.
+
+    There is one record for each project, keyed by its normalised name. A
+    record is a dict holding whichever of these fields have been fetched
+    so far:
+
+      - 'name': the name of the project as the package index spells it
+      - 'releases': the list of release versions
+      - 'urls': a dict mapping release version to its list of download URLs
+      - 'metadata': the document returned by the package index's JSON API
+
+    The kind of version control repository found at a URL, if any, is also
+    stored, keyed by the URL.
+
+    Records are expired 'ttl' seconds after they were first stored.
+
+    '''
+
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL):
+        self.ttl = ttl
+        # Several extensions may use the cache at once when the import tool
+        # processes packages in parallel, so wait for their locks.
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS projects '
+                            '(key TEXT PRIMARY KEY, record TEXT, stored REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS repo_types '
+                            '(url TEXT PRIMARY KEY, type TEXT, stored REAL)')
+
+    def get(self, name):
+        '''Return the record for the named project, or None.'''
+        row = self.db.execute('SELECT record, stored FROM projects '
+                              'WHERE key = ?',
+                              (normalise_project_name(name),)).fetchone()
+        if row is None:
+            return None
+
+        record, stored = row
+        if time.time() - stored > self.ttl:
+            logging.debug('Cached metadata for %s has expired' % name)
+            return None
+
+        return json.loads(record)
+
+    def update(self, project, **fields):
+        '''Store 'fields' in the record for the named project.'''
+        key = normalise_project_name(project)
+
+        record = self.get(project)
+        if record is None:
+            record = {}
+            stored = time.time()
+        else:
+            stored = self.db.execute('SELECT stored FROM projects '
+                                     'WHERE key = ?', (key,)).fetchone()[0]
+        record.update(fields)
+
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO projects VALUES (?, ?, ?)',
+                            (key, json.dumps(record), stored))
+
+    def get_repo_type(self, url):
+        '''Return the kind of repository at 'url', if it is known.
+
+        Returns None if nothing is stored for 'url', otherwise the name of
+        the version control system, or '' if 'url' isn't a repository.
+
+        '''
+        row = self.db.execute('SELECT type, stored FROM repo_types '
+                              'WHERE url = ?', (url,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return row[0]
+
+    def set_repo_type(self, url, repo_type):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO repo_types '
+                            'VALUES (?, ?, ?)',
+                            (url, repo_type or '', time.time()))
+
+    def fill_from_index(self, index):
+        '''Store every project in a local JSON index.
+
+        The index is a dict mapping each project name to the document the
+        package index's JSON API returns for it, which has an 'info' dict
+        and a 'releases' dict mapping each version to its download URLs.
+
+        '''
+        for name, metadata in index.iteritems():
+            releases = metadata.get('releases', {})
+            versions = sorted(releases.iterkeys(),
+                              key=pkg_resources.parse_version, reverse=True)
+            self.update(name, name=name, releases=versions, urls=releases,
+                        metadata=metadata)
+
+class PyPIClient(object):
+    '''Queries the package index, keeping the answers in a PyPIMetadataCache.
+
+    This offers the subset of the PyPI XML-RPC API that the import extensions
+    use, plus the JSON API. Where the XML-RPC API would return an empty list
+    the answer isn't cached, because the project may be uploaded later.
+
+    If 'offline' is True, the package index is never contacted, and anything
+    that isn't in the cache is treated as nonexistent.
+
+    '''
+
+    def __init__(self, cache, offline=False):
+        self.cache = cache
+        self.offline = offline
+        self._server = None
+
+    @property
+    def server(self):
+        if self._server is None:
+            self._server = xmlrpclib.ServerProxy(PYPI_URL)
+        return self._server
+
+    def _cached(self, name, field):
+        record = self.cache.get(name)
+        return record.get(field) if record is not None else None
+
+    def canonical_name(self, name):
+        '''Return the name of the project as the package index spells it.
+
+        See name_or_closest(). Returns None if no project matches 'name'.
+
+        '''
+        canonical = self._cached(name, 'name')
+        if canonical is None and not self.offline:
+            canonical = name_or_closest(self.server, name)
+            if canonical is not None:
+                self.cache.update(canonical, name=canonical)
+        return canonical
+
+    def package_releases(self, name):
+        releases = self._cached(name, 'releases')
+        if releases is None:
+            if self.offline:
+                return []
+            releases = self.server.package_releases(name)
+            if len(releases) > 0:
+                self.cache.update(name, releases=releases)
+        return releases
+
+    def release_urls(self, name, version):
+        urls = self._cached(name, 'urls') or {}
+        if version not in urls:
+            if self.offline:
+                return []
+            urls[version] = self.server.release_urls(name, version)
+            if len(urls[version]) > 0:
+                self.cache.update(name, urls=urls)
+        return urls[version]
+
+    def package_metadata(self, name):
+        '''Return the package index's JSON metadata for a project.'''
+        metadata = self._cached(name, 'metadata')
+        if metadata is None:
+            if self.offline:
+                raise KeyError('%s is not in the local package index' % name)
+            result = requests.get('%s/%s/json' % (PYPI_URL, name))
+            # raise exception if status code is not 200 OK
+            result.raise_for_status()
+            metadata = result.json()
+            self.cache.update(name, metadata=metadata)
+        return metadata
+
+_pypi_client = None
+
+def get_pypi_client():
+    '''Return the PyPIClient shared by everything in this process.
+
+    The Baserock Import tool configures the cache with these environment
+    variables:
+
+      - BASEROCK_IMPORT_CACHE_DIR: directory holding the cache database. If
+        unset, metadata is only cached in memory.
+      - BASEROCK_IMPORT_PYPI_CACHE_TTL: number of seconds that metadata is
+        kept for.
+      - BASEROCK_IMPORT_PYPI_INDEX: path to a local JSON index (see
+        PyPIMetadataCache.fill_from_index()). If set, the cache is only kept
+        in memory and filled from the index, and the real package index is
+        never contacted. This keeps the local index and the metadata cached
+        from the real package index apart.
+
+    '''
+    global _pypi_client
+
+    if _pypi_client is None:
+        cache_dir = os.environ.get('BASEROCK_IMPORT_CACHE_DIR')
+        index_path = os.environ.get('BASEROCK_IMPORT_PYPI_INDEX')
+        if cache_dir and not index_path:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            path = os.path.join(cache_dir, 'pypi-metadata.sqlite')
+        else:
+            path = ':memory:'
+
+        ttl = int(os.environ.get('BASEROCK_IMPORT_PYPI_CACHE_TTL',
+                                 DEFAULT_CACHE_TTL))
+        cache = PyPIMetadataCache(path, ttl)
+
+        if index_path:
+            logging.debug('Using local package index %s' % index_path)
+            with open(index_path) as f:
+                cache.fill_from_index(json.load(f))
+
+        _pypi_client = PyPIClient(cache, offline=bool(index_path))
+
+    return _pypi_client
+
+class ConflictError(Exception):
+    def __init__(self, name, spec_x, spec_y):
+        self.name = name
+        self.specs = [spec_x, spec_y]
+
+        super(ConflictError, self).__init__('%s: %s conflicts with %s'
+                                            % (name, spec_x, spec_y))
+
+class UnmatchedError(Exception):
+    pass
+
+def eq_check((xop, xval), (yop, yval)):
+    assert xop == '=='  # Assumption, '==' spec is x
+
+    ops = (xop, yop)
+    vals = (xval, yval)
+
+    # Map a pair to a function that will return true
+    # if the specs are in conflict.
+    comp = {('==', '=='):   lambda (x, y): x != y,      # conflict if x != y
+            ('==', '!='):   lambda (x, y): x == y,      # conflict if x == y
+            ('==', '<'):    lambda (x, y): x >= y,      # conflict if x >= y
+            ('==', '>'):    lambda (x, y): x <= y,      # conflict if x <= y
+            ('==', '<='):   lambda (x, y): x > y,       # conflict if x > y
+            ('==', '>='):   lambda (x, y): x < y,       # conflict if x < y
+    }
+
+    return comp[ops](vals)
+
+def lt_check((xop, xval), (yop, yval)):
+    assert xop == '<'   # Assumption, '<' spec is x
+
+    ops = (xop, yop)
+    vals = (xval, yval)
+
+    # Map a pair to a function that will return true
+    # if the specs are in conflict.
+    comp = {('<', '<'):     lambda (x, y): False,       # < x < y cannot conflict
+            ('<', '>'):     lambda (x, y): x <= y,      # conflict if x <= y
+            ('<', '<='):    lambda (x, y): False,       # < x <= y cannot conflict
+            ('<', '>='):    lambda (x, y): x <= y       # conflict if x <= y
+    }
+
+    return comp[ops](vals)
+
+def gt_check((xop, xval), (yop, yval)):
+    assert xop == '>'   # Assumption, '>' spec is x
+
+    ops = (xop, yop)
+    vals = (xval, yval)
+
+    # Map a pair to a function that will return true
+    # if the specs are in conflict.
+    comp = {('>', '>'):     lambda (x, y): False,       # > x > y cannot conflict
+            ('>', '<='):    lambda (x, y): x >= y,      # conflict if x >= y
+            ('>', '>='):    lambda (x, y): False,       # > x >= y cannot conflict
+    }
+
+    return comp[ops](vals)
+
+def lte_check((xop, xval), (yop, yval)):
+    assert xop == '<='  # Assumption, '<=' spec is x
+
+    ops = (xop, yop)
+    vals = (xval, yval)
+
+    # Map a pair to a function that will return true
+    # if the specs are in conflict.
+    comp = {('<=', '<='): lambda (x, y): False,   # <= x <= y cannot conflict
+            ('<=', '>='): lambda (x, y): x < y
+    }
+
+    return comp[ops](vals)
+
+def gte_check((xop, xval), (yop, yval)):
+    assert xop == '>='  # Assumption, '>=' spec is x
+
+    ops = (xop, yop)
+    vals = (xval, yval)
+
+    # Map a pair to a function that will return true
+    # if the specs are in conflict.
+    comp = {('>=', '>='): lambda (x, y): False}   # >= x >= y cannot conflict
+
+    return comp[ops](vals)
+
+def reverse_if(c, t1, t2):
+    return [t2, t1] if c else (t1, t2)
+
+def conflict((xop, xval), (yop, yval)):
+    x, y = (xop, xval), (yop, yval)
+    ops = (xop, yop)
+
+    if '==' in ops: return eq_check(*reverse_if(yop == '==', x, y))
+    elif '!=' in ops: return False  # != can only conflict with ==
+    elif '<' in ops: return lt_check(*reverse_if(yop == '<', x, y))
+    elif '>' in ops: return gt_check(*reverse_if(yop == '>', x, y))
+    elif '<=' in ops: return lte_check(*reverse_if(yop == '<=', x, y))
+
+    # not reversing here, >= x >= y should be the only combination possible
+    # here, if it's not then something is wrong.
+    elif '>=' in ops: return gte_check(x, y)
+
+    else: raise UnmatchedError('Got unmatched case (%s, %s)' % x, y)
+
+def conflict_with_set(spec, specset):
+    for s in specset:
+        if conflict(spec, s):
+            return s
+
+    return None
+
+class SpecSet(set):
+    ''' The set of version specs for one project
+
+        As well as the (op, parsed version) pairs themselves, this keeps the
+        interval of versions that they allow between them: a lower and an
+        upper bound, each either None or a (version, inclusive) pair, an
+        optional exact '==' version and a set of '!=' versions. That makes
+        checking a new spec, and finding the releases that satisfy the set,
+        independent of the number of specs.
+
+        Specs with operators that aren't understood are stored, but make the
+        interval 'opaque', in which case the specs are checked one by one.
+    '''
+    def __init__(self, specs=()):
+        super(SpecSet, self).__init__()
+        self.lower = None
+        self.upper = None
+        self.equal = None
+        self.excluded = set()
+        self.opaque = False
+
+        for spec in specs:
+            self.add(spec)
+
+    def _narrowed(self, (op, version)):
+        ''' Return the (lower, upper, equal) bounds with a spec applied '''
+        lower, upper, equal = self.lower, self.upper, self.equal
+
+        if op in ('>', '>='):
+            bound = (version, op == '>=')
+            # For equal versions, an exclusive bound is the tighter one.
+            if lower is None or (bound[0], not bound[1]) > (lower[0],
+                                                            not lower[1]):
+                lower = bound
+        elif op in ('<', '<='):
+            bound = (version, op == '<=')
+            if upper is None or (bound[0], bound[1]) < upper:
+                upper = bound
+        elif op == '==':
+            if equal is None:
+                equal = version
+            elif equal != version:
+                return None
+
+        return lower, upper, equal
+
+    def _allows(self, lower, upper, equal, excluded):
+        if lower is not None and upper is not None:
+            if lower[0] > upper[0]:
+                return False
+            if lower[0] == upper[0] and not (lower[1] and upper[1]):
+                return False
+
+        if equal is not None:
+            if equal in excluded:
+                return False
+            if lower is not None and not (equal > lower[0] or
+                                          (lower[1] and equal == lower[0])):
+                return False
+            if upper is not None and not (equal < upper[0] or
+                                          (upper[1] and equal == upper[0])):
+                return False
+
+        return True
+
+    def conflicting_spec(self, spec):
+        ''' Return a spec in this set that conflicts with 'spec', or None '''
+        op, version = spec
+
+        if self.opaque or op not in OPMAP:
+            return conflict_with_set(spec, self) if len(self) > 0 else None
+
+        bounds = self._narrowed(spec)
+        excluded = self.excluded | set([version]) if op == '!=' \
+                   else self.excluded
+        if bounds is not None and self._allows(*bounds, excluded=excluded):
+            return None
+
+        # Only now is it worth working out which spec is the problem.
+        return conflict_with_set(spec, self)
+
+    def add(self, spec):
+        op, version = spec
+
+        if op not in OPMAP:
+            self.opaque = True
+        elif op == '!=':
+            self.excluded.add(version)
+        else:
+            bounds = self._narrowed(spec)
+            if bounds is not None:
+                self.lower, self.upper, self.equal = bounds
+
+        super(SpecSet, self).add(spec)
+
+    def select(self, versions):
+        ''' Return the indexes of 'versions' that satisfy every spec
+
+            'versions' must be a sorted list of parsed versions. The indexes
+            are returned newest version first.
+        '''
+        if self.opaque:
+            return [i for i in reversed(xrange(len(versions)))
+                    if specs_satisfied(versions[i], self)]
+
+        if self.equal is not None:
+            start = bisect.bisect_left(versions, self.equal)
+            end = bisect.bisect_right(versions, self.equal)
+        else:
+            start, end = 0, len(versions)
+
+        if self.lower is not None:
+            version, inclusive = self.lower
+            bisect_lower = bisect.bisect_left if inclusive \
+                           else bisect.bisect_right
+            start = max(start, bisect_lower(versions, version))
+
+        if self.upper is not None:
+            version, inclusive = self.upper
+            bisect_upper = bisect.bisect_right if inclusive \
+                           else bisect.bisect_left
+            end = min(end, bisect_upper(versions, version))
+
+        return [i for i in reversed(xrange(start, end))
+                if versions[i] not in self.excluded]
+
+def resolve_specs(requirements):
+    requirements = list(requirements)
+
+    logging.debug('Resolving specs from the following requirements: %s',
+                  requirements)
+    specsets = {}
+
+    for r in requirements:
+        if r.project_name not in specsets:
+            specsets[r.project_name] = SpecSet()
+
+        specset = specsets[r.project_name]
+
+        for (op, version) in r.specs:
+            spec = (op, pkg_resources.parse_version(version))
+
+            c = specset.conflicting_spec(spec)
+            if not c:
+                specset.add(spec)
+            else:
+                raise ConflictError(r.project_name, c, spec)
+
+    return specsets
+
+def format_specs(specset):
+    ''' Return specs as a requirement specifier, such as '>=1.0,<2.0'
+
+        An empty string means that any version will do.
+    '''
+    return ','.join(sorted('%s%s' % (op, version)
+                           for (op, version) in specset))
+
+# The release list of each project that was last parsed, with the parsed and
+# sorted releases, by project name. See sorted_releases().
+_sorted_releases = {}
+
+def sorted_releases(client, proj_name):
+    ''' Return the releases of a project, parsed and sorted oldest first
+
+        Returns a pair of lists: the parsed versions, and the corresponding
+        version strings. The releases are asked for every time, so that
+        expiry of the client's cache is honoured, but they are only parsed
+        again if they have changed.
+    '''
+    releases = client.package_releases(proj_name)
+
+    cached = _sorted_releases.get(proj_name)
+    if cached is None or cached[0] != releases:
+        logging.debug('Found %d releases of %s: %s'
+                      % (len(releases), proj_name, releases))
+
+        parsed = sorted((pkg_resources.parse_version(v), v) for v in releases)
+        cached = (list(releases), [p for (p, _) in parsed],
+                  [v for (_, v) in parsed])
+        _sorted_releases[proj_name] = cached
+
+    return cached[1], cached[2]
+
+def resolve_versions(specsets):
+    logging.debug('Resolving versions')
+    versions = {}
+
+    client = get_pypi_client()
+
+    for (proj_name, specset) in specsets.iteritems():
+        if not isinstance(specset, SpecSet):
+            specset = SpecSet(specset)
+
+        # Bit of a hack to deal with pypi case insensitivity
+        new_proj_name = client.canonical_name(proj_name)
+        if new_proj_name == None:
+            error("Couldn't find any project with name '%s'" % proj_name)
+
+        logging.debug("Treating %s as %s" % (proj_name, new_proj_name))
+        proj_name = new_proj_name
+
+        parsed_releases, releases = sorted_releases(client, proj_name)
+
+        # Newest first, so that the first candidate is the latest release
+        # that satisfies the specs.
+        candidates = [releases[i] for i in specset.select(parsed_releases)]
+
+        if len(candidates) == 0:
+            error("Couldn't find any version of %s to satisfy: %s"
+                  % (proj_name, specset))
+
+        logging.debug('Found %d releases of %s that satisfy constraints: %s' %
+                      (len(candidates), proj_name, candidates))
+
+        assert proj_name not in versions
+        versions[proj_name] = candidates
+
+    return versions
+
 # We subclass the ImportExtension to setup the logger,
 # so that we can send logs to the import tool's log
 class PythonExtension(ImportExtension):
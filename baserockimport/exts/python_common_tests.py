@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import time
+
+import unittest
+
+import importer_python_common
+
+FAKE_INDEX = {
+    'Flask-Foo': {
+        'info': {'name': 'Flask-Foo', 'home_page': 'http://example.com/'},
+        'releases': {
+            '0.9': [{'url': 'http://example.com/Flask-Foo-0.9.tar.gz'}],
+            '0.10': [{'url': 'http://example.com/Flask-Foo-0.10.tar.gz'}],
+        }
+    }
+}
+
+class FakeServer(object):
+    '''Stands in for the PyPI XML-RPC server, counting the calls made.'''
+
+    def __init__(self):
+        self.calls = []
+
+    def package_releases(self, name):
+        self.calls.append(('package_releases', name))
+        return ['1.0'] if name == 'foo' else []
+
+    def release_urls(self, name, version):
+        self.calls.append(('release_urls', name, version))
+        return [{'url': 'http://example.com/foo-1.0.tar.gz'}]
+
+class PyPIMetadataCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_records_are_keyed_by_normalised_name(self):
+        cache = importer_python_common.PyPIMetadataCache(self.path)
+        cache.update('Foo_Bar', name='Foo_Bar')
+        cache.update('foo-bar', releases=['1.0'])
+
+        self.assertEqual(cache.get('FOO-BAR'),
+                         {'name': 'Foo_Bar', 'releases': ['1.0']})
+
+    def test_records_persist(self):
+        importer_python_common.PyPIMetadataCache(self.path).update(
+            'foo', releases=['1.0'])
+
+        cache = importer_python_common.PyPIMetadataCache(self.path)
+        self.assertEqual(cache.get('foo'), {'releases': ['1.0']})
+
+    def test_records_expire(self):
+        cache = importer_python_common.PyPIMetadataCache(self.path, ttl=60)
+        cache.update('foo', releases=['1.0'])
+
+        real_time = time.time
+        try:
+            time.time = lambda: real_time() + 120
+            self.assertEqual(cache.get('foo'), None)
+        finally:
+            time.time = real_time
+
+class PyPIClientTests(unittest.TestCase):
+
+    def make_client(self, offline=False):
+        cache = importer_python_common.PyPIMetadataCache(':memory:')
+        client = importer_python_common.PyPIClient(cache, offline=offline)
+        client._server = FakeServer()
+        return client
+
+    def test_second_lookup_uses_cache(self):
+        client = self.make_client()
+
+        for _ in range(2):
+            self.assertEqual(client.package_releases('foo'), ['1.0'])
+            self.assertEqual(client.release_urls('foo', '1.0'),
+                             [{'url': 'http://example.com/foo-1.0.tar.gz'}])
+
+        self.assertEqual(client.server.calls,
+                         [('package_releases', 'foo'),
+                          ('release_urls', 'foo', '1.0')])
+
+    def test_empty_answers_are_not_cached(self):
+        client = self.make_client()
+
+        client.package_releases('bar')
+        client.package_releases('bar')
+
+        self.assertEqual(len(client.server.calls), 2)
+
+    def test_offline_index(self):
+        client = self.make_client(offline=True)
+        client.cache.fill_from_index(FAKE_INDEX)
+
+        self.assertEqual(client.canonical_name('flask_foo'), 'Flask-Foo')
+        self.assertEqual(client.package_releases('Flask-Foo'),
+                         ['0.10', '0.9'])
+        self.assertEqual(client.release_urls('Flask-Foo', '0.9'),
+                         FAKE_INDEX['Flask-Foo']['releases']['0.9'])
+        self.assertEqual(client.package_metadata('Flask-Foo')['info'],
+                         FAKE_INDEX['Flask-Foo']['info'])
+
+        self.assertEqual(client.canonical_name('missing'), None)
+        self.assertEqual(client.package_releases('missing'), [])
+        self.assertEqual(client.server.calls, [])
+
+if __name__ == '__main__':
+    unittest.main()
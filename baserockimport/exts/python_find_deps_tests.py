@@ -16,9 +16,13 @@
 
 import unittest
 import random
+import os
+import shutil
+import tempfile
 
 import imp
 python_find_deps = imp.load_source('python_find_deps', 'python.find_deps')
+python_resolve = imp.load_source('python_resolve', 'python.resolve')
 
 from pkg_resources import parse_requirements, parse_version
 
@@ -357,6 +361,144 @@ class ConflictDetectionTests(unittest.TestCase):
         self.assertEqual(specs, expected_specs)
 
 
+class StaticRequirementsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+
+    def write(self, filename, text):
+        path = os.path.join(self.source, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def find(self):
+        build, runtime = python_find_deps.find_static_requirements(
+            self.source, 'foo', '1.0')
+
+        def names(requirements):
+            if requirements is None:
+                return None
+            return sorted(str(r) for r in requirements)
+
+        return names(build), names(runtime)
+
+    def test_egg_info(self):
+        self.write('setup.py', 'setup(install_requires=deps)')
+        self.write('foo.egg-info/PKG-INFO', 'Name: foo\nVersion: 1.0\n')
+        self.write('foo.egg-info/requires.txt',
+                   'bar>=1.0\nbaz\n\n[test]\nnose\n')
+
+        self.assertEqual(self.find(), ([], ['bar>=1.0', 'baz']))
+
+    def test_stale_egg_info_is_ignored(self):
+        # Left behind by an egg_info run for another version, and not part
+        # of the upstream repository.
+        self.write('setup.py', 'setup(install_requires=deps)')
+        self.write('foo.egg-info/PKG-INFO', 'Name: foo\nVersion: 0.9\n')
+        self.write('foo.egg-info/requires.txt', 'bar\n')
+
+        self.assertEqual(self.find(), ([], None))
+
+    def test_setup_cfg(self):
+        self.write('setup.py', 'from setuptools import setup\nsetup()\n')
+        self.write('setup.cfg', '[options]\n'
+                                'install_requires =\n'
+                                '    bar>=1.0\n'
+                                '    baz; python_version < "1"\n'
+                                'setup_requires = cython\n')
+
+        self.assertEqual(self.find(), (['cython'], ['bar>=1.0']))
+
+    def test_pbr(self):
+        self.write('setup.py',
+                   'setuptools.setup(setup_requires=["pbr"], pbr=True)')
+        self.write('requirements.txt', '# Comment\nbar>=1.0 # Apache-2.0\n')
+
+        self.assertEqual(self.find(), (['pbr'], ['bar>=1.0']))
+
+    def test_plain_setup_py_uses_requirements_txt(self):
+        self.write('setup.py', 'setup(name="foo")')
+        self.write('requirements.txt', 'bar\n')
+
+        self.assertEqual(self.find(), ([], ['bar']))
+
+    def test_inconclusive(self):
+        # setup.py computes its requirements, and requirements.txt includes
+        # another file, so pip and setuptools must be run.
+        self.write('setup.py', 'setup(install_requires=r, setup_requires=s)')
+        self.write('requirements.txt', '-r base.txt\n')
+
+        self.assertEqual(self.find(), (None, None))
+
+
+class FakeClient(object):
+
+    def __init__(self, releases):
+        self.releases = releases
+
+    def package_releases(self, name):
+        return self.releases[name]
+
+class ImportWideResolutionTests(unittest.TestCase):
+
+    def test_format_specs(self):
+        specsets = python_find_deps.resolve_specs(
+            parse_requirements(['a >= 1.0, < 2.0', 'a != 1.5', 'b']))
+
+        self.assertEqual(python_find_deps.format_specs(specsets['a']),
+                         '!=1.5,<2.0,>=1.0')
+        self.assertEqual(python_find_deps.format_specs(specsets['b']), '')
+
+    def test_chooses_newest_version_satisfying_every_package(self):
+        client = FakeClient({'resolve-a': ['0.9', '1.0', '1.5', '2.0']})
+        constraints = [['x-1.0', '>=1.0'], ['y-1.0', '<2.0'], ['z-1.0', '']]
+
+        result = python_resolve.choose_version(client, 'resolve-a',
+                                               constraints)
+
+        self.assertEqual(result, {'version': '1.5'})
+
+    def test_reports_conflicting_packages(self):
+        client = FakeClient({'resolve-b': ['1.0', '2.0']})
+        constraints = [['x-1.0', '<1.0'], ['y-1.0', '>=2.0']]
+
+        result = python_resolve.choose_version(client, 'resolve-b',
+                                               constraints)
+
+        self.assertIn('<1.0 for x-1.0, >=2.0 for y-1.0', result['error'])
+
+    def test_sees_new_releases(self):
+        client = FakeClient({'resolve-c': ['1.0']})
+        constraints = [['x-1.0', '>=1.0']]
+
+        python_resolve.choose_version(client, 'resolve-c', constraints)
+        client.releases['resolve-c'] = ['1.0', '1.1']
+        result = python_resolve.choose_version(client, 'resolve-c',
+                                               constraints)
+
+        self.assertEqual(result, {'version': '1.1'})
+
+    def test_checks_chosen_version(self):
+        constraints = [['x-1.0', '>=1.0'], ['y-1.0', '<2.0']]
+
+        self.assertEqual(python_resolve.check_version('c', '1.5', constraints),
+                         {'version': '1.5'})
+
+        result = python_resolve.check_version('c', '2.0', constraints)
+        self.assertIn('<2.0 for y-1.0', result['error'])
+        self.assertNotIn('x-1.0', result['error'])
+
+
 if __name__ == '__main__':
-    suite = unittest.TestLoader().loadTestsFromTestCase(ConflictDetectionTests)
+    suite = unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(ConflictDetectionTests),
+        unittest.TestLoader().loadTestsFromTestCase(StaticRequirementsTests),
+        unittest.TestLoader().loadTestsFromTestCase(
+            ImportWideResolutionTests),
+    ])
     unittest.TextTestRunner(verbosity=2).run(suite)
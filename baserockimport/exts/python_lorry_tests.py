@@ -66,6 +66,44 @@ class Tests(unittest.TestCase):
                                                lorry_json), url)
         self.assertTrue('compression' not in lorry_json)
 
+    def test_repo_lorry_lists_product(self):
+        lorry_json = python_lorry.str_repo_lorry('Foo', 'git',
+                                                 'git://foobar/foo')
+        lorry = json.loads(lorry_json)['python-packages/foo']
+        self.assertEqual(lorry['x-products-python'], ['Foo'])
+
+        lorry_json = python_lorry.make_tarball_lorry('Foo',
+                                                     'http://foobar/foo.tgz')
+        lorry = json.loads(lorry_json)['python-packages/foo-tarball']
+        self.assertTrue('x-products-python' not in lorry)
+
+    def run_probes(self, probes, timeout=10):
+        old_probes = python_lorry.VCS_PROBES
+        python_lorry.VCS_PROBES = probes
+        try:
+            return python_lorry.probe_repo_type('url', timeout=timeout)
+        finally:
+            python_lorry.VCS_PROBES = old_probes
+
+    def test_probe_prefers_earlier_vcs(self):
+        # The second probe answers first, but the first one is preferred.
+        probes = [('a', ['sh', '-c', 'sleep 0.2']), ('b', ['true'])]
+        self.assertEqual(self.run_probes(probes), ('a', True))
+
+    def test_probe_falls_through_failures(self):
+        probes = [('a', ['false']), ('b', ['nonexistent-vcs']),
+                  ('c', ['true'])]
+        self.assertEqual(self.run_probes(probes), ('c', True))
+
+    def test_probe_timeout(self):
+        probes = [('a', ['sh', '-c', 'sleep 10']), ('b', ['false'])]
+        self.assertEqual(self.run_probes(probes, timeout=0.2), (None, False))
+
+    def test_probe_timeout_with_answer(self):
+        # 'b' succeeded, but 'a' is preferred and might have succeeded too.
+        probes = [('a', ['sh', '-c', 'sleep 10']), ('b', ['true'])]
+        self.assertEqual(self.run_probes(probes, timeout=0.2), ('b', False))
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(Tests)
@@ -0,0 +1,86 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+import morphlib
+
+import logging
+import os
+
+
+class GitMirror(object):
+    '''A bare Git mirror of a source repo, as created by Lorry.
+
+    Rather than cloning the mirror, which copies every object in it, source
+    code is checked out into Git worktrees attached to the mirror. There is
+    one worktree per ref, so different versions of the same project each get
+    their own working tree, and all of them share the objects and refs of the
+    mirror. Nothing needs to be fetched into a worktree after Lorry has
+    updated the mirror.
+
+    This provides the parts of the morphlib.gitdir.GitDirectory interface
+    that the import loop uses for the repo itself. Requires Git 2.5 or later.
+
+    '''
+
+    def __init__(self, dirname, worktrees_dir):
+        self.dirname = dirname
+        self.worktrees_dir = worktrees_dir
+
+    def __str__(self):
+        return self.dirname
+
+    def _git(self, args, **kwargs):
+        return cliapp.runcmd(['git'] + args, cwd=self.dirname, **kwargs)
+
+    def ref_exists(self, ref):
+        exit, out, err = cliapp.runcmd_unchecked(
+            ['git', 'rev-parse', '--verify', '-q', '%s^{commit}' % ref],
+            cwd=self.dirname)
+        return exit == 0
+
+    def resolve_ref_to_commit(self, ref):
+        return self._git(
+            ['rev-parse', '--verify', '%s^{commit}' % ref]).strip()
+
+    def worktree_path(self, ref):
+        return os.path.join(self.worktrees_dir, ref.replace('/', '_'))
+
+    def checkout(self, ref):
+        '''Return a GitDirectory for a worktree with 'ref' checked out.
+
+        The worktree is created if it doesn't exist yet. If it does exist, it
+        is moved to the commit that 'ref' points to now, in case the mirror
+        has been updated since.
+
+        '''
+        path = self.worktree_path(ref)
+        commit = self.resolve_ref_to_commit(ref)
+
+        if os.path.exists(path):
+            worktree = morphlib.gitdir.GitDirectory(path)
+            if worktree.resolve_ref_to_commit('HEAD') != commit:
+                worktree.checkout(commit)
+        else:
+            logging.debug('Adding worktree %s of %s at %s', path,
+                          self.dirname, ref)
+            # Forget about worktrees that have been deleted by hand, in case
+            # this path was one of them.
+            self._git(['worktree', 'prune'])
+            self._git(['worktree', 'add', '--detach', path, commit])
+            worktree = morphlib.gitdir.GitDirectory(path)
+
+        return worktree
@@ -47,22 +47,50 @@ class LorrySet(object):
     lorry *file* contains one or more *entries*. The filename of a lorry file
     is not necessarily linked to the name of any lorry entry that it contains.
 
+    Parsing thousands of .lorry files takes a while, so the LorrySet keeps an
+    index which records, for each file, the names of the entries it contains
+    and the 'x-products-$KIND' fields of each entry. If 'index_path' is given,
+    the index is saved there and reused next time, and only files whose
+    modification time or size has changed since then are parsed again. Lorry
+    entries themselves are only loaded when they are first needed.
+
+    If 'buffered' is True, changes made by add() are kept in memory until
+    flush() is called, so that a .lorry file that receives many new entries
+    is only written out once. Each file is still replaced atomically.
+
     '''
 
-    def __init__(self, lorries_path):
+    INDEX_FORMAT_VERSION = 1
+
+    def __init__(self, lorries_path, index_path=None, buffered=False):
         '''Initialise a LorrySet instance for the given directory.
 
-        This will load and parse all of the .lorry files inside 'lorries_path'
-        into memory.
+        This will index all of the .lorry files inside 'lorries_path'.
 
         '''
         self.path = lorries_path
+        self.index_path = index_path
+        self.buffered = buffered
+
+        # Index records for each lorry file, keyed by path relative to
+        # self.path. See _index_record().
+        self.files = {}
+        self.index_changed = False
+
+        # Maps from entry name to the lorry file containing it, and from
+        # (kind, product name) to entry name.
+        self.entry_files = {}
+        self.products = {}
+
+        # Parsed contents of the lorry files that have been needed so far, and
+        # the lorry files with changes that have not been written out yet.
+        self.contents = {}
+        self.dirty_files = set()
 
         if os.path.exists(lorries_path):
-            self.data = self._parse_all_lorries()
+            self._index_all_lorries()
         else:
             os.makedirs(lorries_path)
-            self.data = {}
 
     def all_lorry_files(self):
         '''Return the path of each lorry file in this set.'''
@@ -71,28 +99,90 @@ class LorrySet(object):
                 if filename.endswith('.lorry'):
                     yield os.path.join(dirpath, filename)
 
-    def _parse_all_lorries(self):
-        lorry_set = {}
+    def _read_saved_index(self):
+        if self.index_path is None or not os.path.exists(self.index_path):
+            return {}
 
-        # We keep track of which entry came from which file, but only while
-        # loading everything into memory (to allow us to give more helpful
-        # errors).
-        filenames = {}
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except ValueError as e:
+            logging.warning('Ignoring invalid lorry index %s: %s',
+                            self.index_path, e)
+            return {}
 
-        for lorry_file in self.all_lorry_files():
-            lorry = self._parse_lorry(lorry_file)
+        if index.get('version') != self.INDEX_FORMAT_VERSION:
+            return {}
+        return index['files']
 
-            lorry_items = lorry.items()
+    def _products_fields(self, entry):
+        '''Return the 'x-products-$KIND' fields of a lorry entry, by kind.'''
+        return dict(
+            (field[len('x-products-'):], products)
+            for field, products in entry.iteritems()
+            if field.startswith('x-products-'))
 
-            for key, value in lorry_items:
-                if key in lorry_set:
-                    raise DuplicateLorryError(lorry_file, key, filenames[key])
+    def _index_record(self, lorry_file, lorry):
+        '''Summarise the contents of a lorry file for the index.'''
+        st = os.stat(lorry_file)
 
-                filenames[key] = lorry_file
+        entries = {}
+        for name, entry in lorry.iteritems():
+            entries[name] = self._products_fields(entry)
 
-            lorry_set.update(lorry_items)
+        return {'mtime': st.st_mtime, 'size': st.st_size, 'entries': entries}
 
-        return lorry_set
+    def _index_all_lorries(self):
+        saved_files = self._read_saved_index()
+
+        for lorry_file in self.all_lorry_files():
+            relpath = os.path.relpath(lorry_file, self.path)
+            st = os.stat(lorry_file)
+
+            record = saved_files.get(relpath)
+            if (record is None or record['mtime'] != st.st_mtime or
+                    record['size'] != st.st_size):
+                record = self._index_record(
+                    lorry_file, self._parse_lorry(lorry_file))
+                self.index_changed = True
+
+            self.files[relpath] = record
+
+        if set(saved_files) != set(self.files):
+            self.index_changed = True
+
+        # We keep track of which entry came from which file, to allow us to
+        # give more helpful errors.
+        for relpath in sorted(self.files):
+            lorry_file = os.path.join(self.path, relpath)
+            for name in self.files[relpath]['entries']:
+                if name in self.entry_files:
+                    raise DuplicateLorryError(
+                        lorry_file, name, self.entry_files[name])
+                self.entry_files[name] = lorry_file
+            for name, products in self.files[relpath]['entries'].iteritems():
+                self._index_products(name, products)
+
+        self.save_index()
+
+    def _index_products(self, name, products):
+        for kind, product_names in products.iteritems():
+            for product_name in product_names:
+                self.products.setdefault((kind, product_name), name)
+
+    def save_index(self):
+        '''Save the index of lorry files, if it has changed.'''
+        if self.index_path is None or not self.index_changed:
+            return
+
+        index_dir = os.path.dirname(self.index_path)
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        with morphlib.savefile.SaveFile(self.index_path, 'w') as f:
+            json.dump({'version': self.INDEX_FORMAT_VERSION,
+                       'files': self.files}, f)
+        self.index_changed = False
 
     def _parse_lorry(self, lorry_file):
         try:
@@ -103,9 +193,15 @@ class LorrySet(object):
             raise LorrySetError(
                 "Error parsing %s: %s" % (lorry_file, e))
 
+    def _load_lorry_file(self, lorry_file):
+        if lorry_file not in self.contents:
+            self.contents[lorry_file] = self._parse_lorry(lorry_file)
+        return self.contents[lorry_file]
+
     def get_lorry(self, name):
         '''Return the lorry entry for the named project.'''
-        return {name: self.data[name]}
+        lorry = self._load_lorry_file(self.entry_files[name])
+        return {name: lorry[name]}
 
     def find_lorry_for_package(self, kind, package_name):
         '''Find the lorry entry for a given foreign package, or return None.
@@ -116,14 +212,10 @@ class LorrySet(object):
         named $KIND.
 
         '''
-        key = 'x-products-%s' % kind
-        for name, lorry in self.data.iteritems():
-            products = lorry.get(key, [])
-            for entry in products:
-                if entry == package_name:
-                    return {name: lorry}
-
-        return None
+        name = self.products.get((kind, package_name))
+        if name is None:
+            return None
+        return self.get_lorry(name)
 
     def _check_for_conflicts_in_standard_fields(self, existing, new):
         '''Ensure that two lorries for the same project do actually match.'''
@@ -159,17 +251,37 @@ class LorrySet(object):
             existing[field] = new[field]
 
     def _add_lorry_entry_to_lorry_file(self, filename, entry):
-        if os.path.exists(filename):
-            with open(filename) as f:
-                contents = json.load(f)
+        if filename in self.contents:
+            contents = self.contents[filename]
+        elif os.path.exists(filename):
+            contents = self._parse_lorry(filename)
         else:
             contents = {}
 
         contents.update(entry)
+        self.contents[filename] = contents
+
+        for name, info in entry.iteritems():
+            self._index_products(name, self._products_fields(info))
+
+        self.dirty_files.add(filename)
+        if not self.buffered:
+            self.flush()
+
+    def flush(self):
+        '''Write out every .lorry file that has changes, and the index.'''
+        for filename in sorted(self.dirty_files):
+            contents = self.contents[filename]
+            with morphlib.savefile.SaveFile(filename, 'w') as f:
+                json.dump(contents, f, indent=4, separators=(',', ': '),
+                          sort_keys=True)
+
+            relpath = os.path.relpath(filename, self.path)
+            self.files[relpath] = self._index_record(filename, contents)
+            self.index_changed = True
+            self.dirty_files.discard(filename)
 
-        with morphlib.savefile.SaveFile(filename, 'w') as f:
-            json.dump(contents, f, indent=4, separators=(',', ': '),
-                      sort_keys=True)
+        self.save_index()
 
     def add(self, filename, lorry_entry):
         '''Add a lorry entry to the named .lorry file.
@@ -198,7 +310,7 @@ class LorrySet(object):
             raise LorrySetError(
                 'Invalid URL in lorry %s: %s' % (filename, info.get('url')))
 
-        if project_name in self.data:
+        if project_name in self.entry_files:
             stored_lorry = self.get_lorry(project_name)
 
             self._check_for_conflicts_in_standard_fields(
@@ -207,6 +319,6 @@ class LorrySet(object):
                 stored_lorry[project_name], lorry_entry[project_name])
             lorry_entry = stored_lorry
         else:
-            self.data[project_name] = info
+            self.entry_files[project_name] = filename
 
         self._add_lorry_entry_to_lorry_file(filename, lorry_entry)
@@ -18,10 +18,17 @@ import cliapp
 import morphlib
 import networkx
 
+import collections
+import hashlib
+import imp
 import json
 import logging
+import multiprocessing.pool
 import os
+import Queue
+import sys
 import tempfile
+import threading
 import time
 
 import baserockimport
@@ -31,75 +38,170 @@ class BaserockImportException(cliapp.AppException):
     pass
 
 
-def find(iterable, match):
-    return next((x for x in iterable if match(x)), None)
+def extensions_dir():
+    module_dir = os.path.dirname(baserockimport.__file__)
+    return os.path.join(module_dir, 'exts')
 
 
-def run_extension(filename, args):
+# Extensions can write records to stdout as they go, instead of one document
+# when they finish. The format is defined along with emit_record(), which
+# extensions use to write them, in exts/importer_base.py.
+RECORD_SEPARATOR = imp.load_source(
+    'baserockimport_importer_base',
+    os.path.join(extensions_dir(), 'importer_base.py')).RECORD_SEPARATOR
+
+# Only this many of the last lines that an extension writes to stderr are
+# kept for the error message if it fails. All of them are logged.
+MAX_STDERR_LINES = 100
+
+
+def dispatch_records(lines, report_record, description):
+    '''Pass each record in 'lines' to 'report_record'.
+
+    Returns the lines that aren't records. As for records that come from a
+    running extension (see run_extension()), an error in one record doesn't
+    stop the others being handled: the first error is raised once they have
+    all been seen, with 'description' saying where the lines came from.
+
+    '''
+    output = []
+    record_errors = []
+    for line in lines:
+        if not line.startswith(RECORD_SEPARATOR):
+            output.append(line)
+            continue
+
+        try:
+            report_record(json.loads(line[1:]))
+        except Exception as e:
+            logging.debug('Error handling record "%s": %s', line[1:], e)
+            record_errors.append(e)
+
+    if len(record_errors) > 0:
+        raise BaserockImportException(
+            'Unable to handle %s: %s' % (description, record_errors[0]))
+    return output
+
+
+def run_extension(filename, args, workers=None, report_record=None):
     '''Run the import extension 'filename' with the given arguments.
 
     Returns the output written by the extension to its stdout.
 
+    If 'report_record' is given, records that the extension writes are
+    parsed and passed to it as they arrive, while the extension is still
+    running, and they are not included in the returned output.
+
     If the extension subprocess returns an
     error code (any value other than zero) then BaserockImportException will be
     raised, with the contents of stderr stored in its .message attribute.
 
+    If 'workers' is an ExtensionWorkerPool, the extension is run in one of its
+    long-lived worker processes if possible, otherwise a new subprocess is
+    started just for this call.
+
     Note that the stdout and strerr processing expects each line to be
     terminated with '\n' (newline character). Any output beyond the last \n
     character will be ignored.
 
     '''
     output = []
-    errors = []
+    errors = collections.deque(maxlen=MAX_STDERR_LINES)
+    stderr_line_count = [0]
+    record_errors = []
 
     ext_logger = logging.getLogger(filename)
 
     def report_extension_stdout(line):
-        output.append(line)
+        if report_record is None or not line.startswith(RECORD_SEPARATOR):
+            output.append(line)
+            return
+
+        # An exception here would stop the output being read, so it is
+        # raised once the extension has finished.
+        try:
+            report_record(json.loads(line[1:]))
+        except Exception as e:
+            logging.debug('Error handling record "%s": %s', line[1:], e)
+            record_errors.append(e)
 
     def report_extension_stderr(line):
         logging.debug('Received "%s" on stderr' % line)
         errors.append(line)
+        stderr_line_count[0] += 1
 
     def report_extension_logger(line):
         ext_logger.debug(line)
 
-    ext = morphlib.extensions.ExtensionSubprocess(
-        report_stdout=report_extension_stdout,
-        report_stderr=report_extension_stderr,
-        report_logger=report_extension_logger,
-    )
-
-    def extensions_dir():
-        module_dir = os.path.dirname(baserockimport.__file__)
-        return os.path.join(module_dir, 'exts')
-
     extension_path = os.path.join(extensions_dir(), filename)
 
     logging.debug("Running %s %s" % (extension_path, args))
-    cwd = '.'
-    returncode = ext.run(extension_path, args, cwd, os.environ)
+
+    returncode = None
+    if workers is not None:
+        returncode = workers.run(
+            extension_path, args, report_extension_stdout,
+            report_extension_stderr)
+
+    if returncode is None:
+        ext = morphlib.extensions.ExtensionSubprocess(
+            report_stdout=report_extension_stdout,
+            report_stderr=report_extension_stderr,
+            report_logger=report_extension_logger,
+        )
+
+        cwd = '.'
+        returncode = ext.run(extension_path, args, cwd, os.environ)
 
     if returncode == 0:
         ext_logger.info('succeeded')
     else:
         for line in errors:
             ext_logger.error(line)
+        omitted = stderr_line_count[0] - len(errors)
+        if omitted > 0:
+            errors.appendleft('(%i earlier lines omitted, see the log)' %
+                              omitted)
         message = '%s failed with code %s: %s' % (
             filename, returncode, '\n'.join(errors))
         raise BaserockImportException(message)
 
+    if len(record_errors) > 0:
+        raise BaserockImportException(
+            'Unable to handle output of %s: %s' % (filename, record_errors[0]))
+
     return '\n'.join(output)
 
 
+class ImportGoal(object):
+    '''A package to import, and the stratum to generate for it.'''
+
+    def __init__(self, kind, name, version, stratum_name=None):
+        self.kind = kind
+        self.name = name
+        self.version = version
+        self.stratum_name = stratum_name or name
+
+        # The Package object for the goal, once the import has started.
+        self.package = None
+
+    def __str__(self):
+        return '%s %s' % (self.kind, self.name)
+
+
 class ImportLoop(object):
     '''Import a package and all of its dependencies into Baserock.
 
     This class holds the state for the processing loop.
 
+    More goal packages can be added with add_goal(). They are imported one
+    after another in one run, and dependencies that they share are only
+    processed once.
+
     '''
 
-    def __init__(self, app, goal_kind, goal_name, goal_version):
+    def __init__(self, app, goal_kind, goal_name, goal_version,
+                 stratum_name=None):
         '''Set up an ImportLoop to process dependencies of one goal package.'''
 
         self.app = app
@@ -107,15 +209,178 @@ class ImportLoop(object):
         self.goal_name = goal_name
         self.goal_version = goal_version
 
+        self.goals = []
+        self.add_goal(goal_kind, goal_name, goal_version, stratum_name)
+
+        self.cache_dir = os.path.abspath(self.app.settings['cache-dir'])
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
         self.lorry_set = baserockimport.lorryset.LorrySet(
-            self.app.settings['lorries-dir'])
+            self.app.settings['lorries-dir'],
+            index_path=self._lorry_index_path(), buffered=True)
         self.morph_set = baserockimport.morphsetondisk.MorphologySetOnDisk(
-            self.app.settings['definitions-dir'])
+            self.app.settings['definitions-dir'],
+            cache_dir=os.path.join(self.cache_dir, 'morphologies'))
 
         self.morphloader = morphlib.morphloader.MorphologyLoader()
 
         self.importers = {}
 
+        self._set_up_extension_environment()
+
+        if self.app.settings['result-cache']:
+            result_cache_dir = (self.app.settings['result-cache-dir'] or
+                                os.path.join(self.cache_dir, 'results'))
+            self.result_cache = baserockimport.resultcache.ResultCache(
+                os.path.abspath(result_cache_dir))
+        else:
+            self.result_cache = None
+
+        if self.app.settings['profile-dir']:
+            self.profiler = baserockimport.profiler.ImportProfiler()
+        else:
+            self.profiler = baserockimport.profiler.NullProfiler()
+
+        if self.app.settings['persistent-extensions']:
+            self.extension_workers = (
+                baserockimport.extensionworkers.ExtensionWorkerPool())
+        else:
+            self.extension_workers = None
+
+        # Every Package object created during the import, whether it is still
+        # queued, has been processed or has failed.
+        self.packages = baserockimport.package.PackageRegistry()
+
+        # When packages are processed concurrently (see the 'jobs' setting),
+        # these locks serialise access to the state that the worker threads
+        # share. Each source repository gets its own lock, because several
+        # packages can come from one repo and a Git checkout can only have
+        # one version checked out at a time.
+        self.lorry_set_lock = threading.Lock()
+        self.morph_set_lock = threading.Lock()
+        self.repo_locks = {}
+        self.repo_locks_lock = threading.Lock()
+        self.lorry_locks = {}
+        self.lorry_locks_lock = threading.Lock()
+        self.generated_lorries = {}
+        self.prefetched_lorries = set()
+
+        # Lorry entries for the dependencies that extensions report are
+        # generated by these threads while the queue is being processed.
+        # See _prepare_lorry().
+        self.lorry_pool = None
+
+        # Lorry is run for many repos at once where possible (see
+        # _mirror_sources()). This records the repos that have been mirrored
+        # or updated during this run.
+        self.mirrored_repos = set()
+
+        # Errors from generating lorry entries or choosing versions, which
+        # happen before a package is processed. They are reported when the
+        # package itself is processed.
+        self.early_errors = {}
+
+        # The requirements on each project whose versions are resolved
+        # import-wide, keyed by (kind, name). Each one is a pair of the
+        # package that has the requirement and a requirement specifier.
+        self.version_constraints = {}
+
+        # When each source repo's checkout was last updated from its Lorry
+        # mirror, so that repos which already have the wanted ref aren't
+        # fetched again every time. See _source_is_fresh().
+        self.fetch_times = self._load_fetch_times()
+
+        # Packages whose processing has finished and whose dependencies have
+        # been added to the queue.
+        self.completed_packages = set()
+
+        # The goal that each package was first found to be needed by, whose
+        # stratum directory holds its chunk morphology. See add_goal().
+        self.package_goals = {}
+
+        # In incremental mode (see the 'incremental' setting), the stratum
+        # morphology of each goal from the last import, by stratum name, and
+        # whether each package could be restored from them. See
+        # _restore_package_from_stratum().
+        self.existing_strata = {}
+        self.existing_chunk_entries = {}
+        self.restored_from_stratum = {}
+
+        # New lorry entries, and the state of the processing queue, are
+        # written out at checkpoints. See _maybe_checkpoint().
+        self.last_checkpoint_time = time.time()
+
+    def _lorry_index_path(self):
+        '''Return where to keep the index of the lorry set.
+
+        The cache directory may be shared between several lorry sets, so
+        each one gets its own index file.
+
+        '''
+        lorries_dir = os.path.abspath(self.app.settings['lorries-dir'])
+        return os.path.join(
+            self.cache_dir, 'lorry-index',
+            '%s.json' % hashlib.sha1(lorries_dir).hexdigest())
+
+    def _set_up_extension_environment(self):
+        '''Pass the settings that import extensions use to them.
+
+        Extensions are run with the environment of this process, so this is
+        done by setting environment variables.
+
+        '''
+        os.environ['BASEROCK_IMPORT_CACHE_DIR'] = self.cache_dir
+        os.environ['BASEROCK_IMPORT_PYPI_CACHE_TTL'] = str(
+            self.app.settings['pypi-cache-ttl'])
+        os.environ['BASEROCK_IMPORT_RUBYGEMS_CACHE_TTL'] = str(
+            self.app.settings['rubygems-cache-ttl'])
+
+        if self.app.settings['pypi-index']:
+            os.environ['BASEROCK_IMPORT_PYPI_INDEX'] = os.path.abspath(
+                self.app.settings['pypi-index'])
+
+        os.environ['BASEROCK_IMPORT_PYTHON_RESOLUTION'] = (
+            self.app.settings['python-resolution'])
+
+        # Extensions that support it write records as they go (see
+        # run_extension()).
+        os.environ['BASEROCK_IMPORT_RECORDS'] = '1'
+
+    def _resolves_versions_import_wide(self, kind):
+        '''Return True if one version of each project of 'kind' is chosen.
+
+        In that case the importer's find_deps extension reports requirement
+        specifiers instead of versions, which are collected from every package
+        in the import. See _resolve_versions().
+
+        '''
+        return (kind == 'python' and
+                self.app.settings['python-resolution'] == 'import-wide')
+
+    def add_goal(self, kind, name, version, stratum_name=None):
+        '''Add another goal package to import, with a stratum of its own.
+
+        'stratum_name' defaults to the name of the package. The stratum only
+        lists the chunks that the goal needs, but each chunk morphology is
+        only generated once, in the directory of the first goal that needs
+        it. The goals are processed in the order they were added, so this
+        doesn't depend on how many packages are processed at once.
+
+        '''
+        goal = ImportGoal(kind, name, version, stratum_name)
+        for other in self.goals:
+            if (other.kind, other.name, other.version) == (kind, name,
+                                                           version):
+                raise cliapp.AppException(
+                    '%s %s %s is listed more than once' %
+                    (kind, name, version))
+            if other.stratum_name == goal.stratum_name:
+                raise cliapp.AppException(
+                    'Both %s and %s would generate stratum %s' %
+                    (other, goal, goal.stratum_name))
+        self.goals.append(goal)
+
     def enable_importer(self, kind, extra_args=[], **kwargs):
         '''Enable an importer extension in this ImportLoop instance.
 
@@ -127,6 +392,14 @@ class ImportLoop(object):
         software components can depend on other Omnibus software components,
         but also on RubyGems.
 
+        If 'prefetch_lorries' is True, the importer's to_lorry extension
+        supports being run with --prefetch and the names of many packages.
+        See _prefetch_lorry_metadata().
+
+        If 'cache_results' is False, the importer's extensions read more than
+        the source tree of a package and their arguments, and so their output
+        is never kept in the result cache. See _run_extension_for_package().
+
         '''
         assert kind not in self.importers
         self.importers[kind] = {
@@ -135,93 +408,680 @@ class ImportLoop(object):
         }
 
     def run(self):
-        '''Process the goal package and all of its dependencies.'''
+        '''Process the goal packages and all of their dependencies.'''
 
         start_time = time.time()
         start_displaytime = time.strftime('%x %X %Z', time.localtime())
+        description = ', '.join(str(goal) for goal in self.goals)
 
         self.app.status(
-            '%s: Import of %s %s started', start_displaytime, self.goal_kind,
-            self.goal_name)
+            '%s: Import of %s started', start_displaytime, description)
 
         if not self.app.settings['update-existing']:
             self.app.status(
                 'Not updating existing Git checkouts or existing definitions')
 
-        chunk_dir = os.path.join(self.morph_set.path, 'strata', self.goal_name)
-        if not os.path.exists(chunk_dir):
-            os.makedirs(chunk_dir)
-
-        goal = baserockimport.package.Package(
-            self.goal_kind, self.goal_name, self.goal_version)
-        to_process = [goal]
+        for goal in self.goals:
+            chunk_dir = os.path.join(
+                self.morph_set.path, 'strata', goal.stratum_name)
+            if not os.path.exists(chunk_dir):
+                os.makedirs(chunk_dir)
 
         # Every Package object is added as a node in the 'processed' graph.
         # The set of nodes in graph corresponds to the set of packages needed
-        # at runtime for the goal package to function. The edges in the graph
+        # at runtime for the goal packages to function. The edges in the graph
         # correspond to build-time dependencies between packages. This format
         # is convenient when we need to construct a suitable stratum morphology
-        # for the goal package.
+        # for each goal package.
         processed = networkx.DiGraph()
 
         errors = {}
 
+        if self.app.settings['resume'] and os.path.exists(self.state_file):
+            self.app.status('Resuming import from %s', self.state_file)
+            to_process = self._load_state(processed)
+        else:
+            if self.app.settings['resume']:
+                self.app.status('No saved state found at %s, starting from '
+                                'the beginning', self.state_file)
+            to_process = []
+
+        if self.app.settings['incremental']:
+            for goal in self.goals:
+                stratum = self._load_existing_stratum(goal)
+                if stratum is not None:
+                    self.existing_strata[goal.stratum_name] = stratum
+
+        jobs = self.app.settings['jobs']
+        fetch_jobs = self.app.settings['fetch-jobs'] or jobs
+        analysis_jobs = self.app.settings['analysis-jobs'] or jobs
+        self.lorry_pool = multiprocessing.pool.ThreadPool(fetch_jobs)
+        try:
+            for goal in self.goals:
+                # A goal that an earlier goal needs has been processed
+                # already, unless the import was resumed part way through.
+                goal.package = self.packages.get(goal.kind, goal.name,
+                                                 goal.version)
+                if goal.package is None:
+                    goal.package = baserockimport.package.Package(
+                        goal.kind, goal.name, goal.version)
+                    self.packages.add(goal.package)
+                    self.package_goals[goal.package] = goal
+                    to_process.append(goal.package)
+
+                if fetch_jobs > 1 or analysis_jobs > 1:
+                    self._process_queue_in_stages(
+                        to_process, processed, errors, fetch_jobs,
+                        analysis_jobs)
+                else:
+                    self._process_queue(to_process, processed, errors)
+            self._check_import_wide_versions(errors)
+        finally:
+            # Lorry entries that are still being generated are finished off,
+            # but no more are started.
+            self.lorry_pool.terminate()
+            self.lorry_pool.join()
+            self.lorry_pool = None
+            if self.extension_workers is not None:
+                self.extension_workers.close()
+            # This also happens if the import is interrupted with Ctrl+C or
+            # fails with an exception, so no work is lost.
+            self._checkpoint(to_process, processed, errors)
+
+        with self.profiler.phase(None, 'generate stratum'):
+            dependencies = self._dependencies_by_package()
+            for goal in self.goals:
+                needed = self._packages_needed_by(goal, dependencies)
+                goal_graph = processed.subgraph(
+                    [package for package in needed if package in processed])
+                goal_errors = dict((package, error)
+                                   for package, error in errors.iteritems()
+                                   if package in needed)
+                self._maybe_generate_stratum(goal_graph, goal_errors, goal)
+
+        duration = time.time() - start_time
+        end_displaytime = time.strftime('%x %X %Z', time.localtime())
+
+        self.app.status(
+            '%s: Import of %s ended (took %i seconds)', end_displaytime,
+            description, duration)
+
+        self._write_profile()
+
+    def _write_profile(self):
+        '''Write out and summarise the timings, if profiling is enabled.'''
+        profile_dir = self.app.settings['profile-dir']
+        if not profile_dir:
+            return
+
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        report_path = os.path.join(profile_dir, 'report.json')
+        trace_path = os.path.join(profile_dir, 'trace.json')
+        self.profiler.write_report(report_path)
+        self.profiler.write_trace(trace_path)
+
+        for line in self.profiler.summary(self.app.settings['profile-top']):
+            self.app.status('%s', line)
+        self.app.status('Wrote profile report to %s and trace to %s',
+                        report_path, trace_path)
+
+    def _process_queue(self, to_process, processed, errors):
+        '''Process each package in the queue, one at a time.'''
+
         # This is the main processing loop of an import!
 
+        self._mirror_sources(to_process)
+
         while len(to_process) > 0:
             current_item = to_process.pop()
 
+            if current_item.version is None:
+                self._resolve_versions([current_item])
+                self._mirror_sources([current_item])
+
             try:
                 self._process_package(current_item)
-                error = False
+                error = None
             except BaserockImportException as e:
-                self.app.status('%s', e, error=True)
-                errors[current_item] = e
-                error = True
+                error = e
+
+            queue_length = len(to_process)
+            self._handle_processed_package(
+                current_item, error, to_process, processed, errors)
+
+            # Fetch the source of every new dependency with one Lorry run.
+            self._mirror_sources(to_process[queue_length:])
+
+    def _process_queue_in_stages(self, to_process, processed, errors,
+                                 fetch_jobs, analysis_jobs):
+        '''Process the queue as a pipeline of two stages.
+
+        Each package is fetched by one of 'fetch_jobs' worker threads (see
+        _fetch_package()), and then analysed by one of 'analysis_jobs' worker
+        threads (see _analyse_package()). Fetching mostly waits for the
+        network and analysis mostly waits for import extensions, so with a
+        limit for each the network stays busy while packages are analysed,
+        without running more extensions at once than the machine can cope
+        with.
+
+        The dependencies of a package are fetched as soon as it has been
+        handled, without waiting for the packages that were started alongside
+        it. Packages are handled in this thread, in the order they were
+        started rather than the order they finish in, so the resulting graph
+        is the same however long each package takes. Packages that are in the
+        pipeline are already in self.packages, so dependencies on them are not
+        enqueued a second time.
+
+        '''
+        fetch_pool = multiprocessing.pool.ThreadPool(fetch_jobs)
+        analysis_pool = multiprocessing.pool.ThreadPool(analysis_jobs)
+
+        # Each finished package is put here as (package, error, exc_info).
+        # 'exc_info' is set if something unexpected went wrong, in which case
+        # it is raised again in this thread.
+        finished = Queue.Queue()
 
-            if not error:
-                self._update_queue_and_graph(
-                    current_item, current_item.dependencies, to_process,
+        def analyse(package, source):
+            try:
+                self._analyse_package(package, *source)
+                finished.put((package, None, None))
+            except BaserockImportException as e:
+                finished.put((package, e, None))
+            except Exception:
+                finished.put((package, None, sys.exc_info()))
+
+        def fetch(packages):
+            try:
+                # Fetch the source of every package in the batch with one
+                # Lorry run.
+                self._mirror_sources(packages)
+            except Exception:
+                finished.put((packages[0], None, sys.exc_info()))
+                return
+
+            for package in packages:
+                try:
+                    if self._restore_package_from_stratum(package):
+                        finished.put((package, None, None))
+                        continue
+                    source = self._fetch_package(package)
+                except BaserockImportException as e:
+                    finished.put((package, e, None))
+                except Exception:
+                    finished.put((package, None, sys.exc_info()))
+                else:
+                    analysis_pool.apply_async(analyse, (package, source))
+
+        # Packages in the pipeline, in the order they are handled in.
+        started = collections.deque()
+        results = {}
+
+        def start(packages):
+            self._resolve_versions(packages)
+            # The fetch threads each get some of the packages, so this is
+            # done for all of them first.
+            self._prefetch_lorry_metadata(packages)
+            started.extend(packages)
+
+            logging.debug('Starting %i packages', len(packages))
+            n_batches = min(fetch_jobs, len(packages))
+            for i in xrange(n_batches):
+                fetch_pool.apply_async(fetch, (packages[i::n_batches],))
+
+        try:
+            while len(to_process) > 0 or len(started) > 0:
+                if len(to_process) > 0:
+                    # The same order that _process_queue() would pop them in.
+                    new_packages = list(reversed(to_process))
+                    del to_process[:]
+                    start(new_packages)
+
+                current_item = started.popleft()
+                while current_item not in results:
+                    # Calling .get() with a timeout means that Ctrl+C still
+                    # interrupts the main thread.
+                    package, error, exc_info = finished.get(True, sys.maxint)
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    results[package] = error
+
+                self._handle_processed_package(
+                    current_item, results.pop(current_item), to_process,
                     processed, errors)
+        finally:
+            for pool in [fetch_pool, analysis_pool]:
+                pool.terminate()
+                pool.join()
+
+    def _handle_processed_package(self, current_item, error, to_process,
+                                  processed, errors):
+        if error is None:
+            self._update_queue_and_graph(
+                current_item, current_item.dependencies, to_process,
+                processed, errors)
+            self.completed_packages.add(current_item)
+        else:
+            self.app.status('%s', error, error=True)
+            errors[current_item] = error
+
+        self._maybe_checkpoint(to_process, processed, errors)
+
+    def _maybe_checkpoint(self, to_process, processed, errors):
+        interval = self.app.settings['checkpoint-interval']
+        if time.time() - self.last_checkpoint_time >= interval:
+            self._checkpoint(to_process, processed, errors)
+
+    def _checkpoint(self, to_process, processed, errors):
+        '''Save the work done so far to disk.'''
+        logging.debug('Checkpoint: writing out changed lorry files and the '
+                      'state of the import to %s', self.state_file)
+        with self.profiler.phase(None, 'checkpoint'):
+            with self.lorry_set_lock:
+                self.lorry_set.flush()
+            self._save_state(to_process, processed, errors)
+            self._save_fetch_times()
+        self.last_checkpoint_time = time.time()
+
+    @property
+    def fetch_times_file(self):
+        return os.path.join(self.cache_dir, 'fetch-times.json')
+
+    def _load_fetch_times(self):
+        if not os.path.exists(self.fetch_times_file):
+            return {}
+        try:
+            with open(self.fetch_times_file) as f:
+                return json.load(f)
+        except ValueError as e:
+            logging.warning('Ignoring invalid %s: %s',
+                            self.fetch_times_file, e)
+            return {}
+
+    def _save_fetch_times(self):
+        with morphlib.savefile.SaveFile(self.fetch_times_file, 'w') as f:
+            json.dump(dict(self.fetch_times), f)
+
+    @property
+    def state_file(self):
+        '''Path to the saved state of the processing queue for the goals.'''
+        if len(self.goals) == 1:
+            goals = json.dumps(
+                [self.goal_kind, self.goal_name, self.goal_version])
+        else:
+            goals = json.dumps([[goal.kind, goal.name, goal.version,
+                                 goal.stratum_name] for goal in self.goals])
+        return os.path.join(
+            self.cache_dir, 'imports',
+            '%s.json' % hashlib.sha1(goals).hexdigest())
 
-        self._maybe_generate_stratum(processed, errors, self.goal_name)
+    def _save_state(self, to_process, processed, errors):
+        '''Save the processing queue and the work done so far.
 
-        duration = time.time() - start_time
-        end_displaytime = time.strftime('%x %X %Z', time.localtime())
+        Packages that were queued, being processed or that failed are all
+        recorded as queued, so they are processed again when the import is
+        resumed.
+
+        '''
+        packages = sorted(self.packages, key=lambda p: p.key)
+        index = dict((package, i) for i, package in enumerate(packages))
+
+        def package_state(package):
+            state = {
+                'kind': package.kind,
+                'name': package.name,
+                'version': package.version,
+                'required_by': [index[item] for item in package.required_by],
+                'is_build_dep': package.is_build_dep,
+                'goal': self.goals.index(self._goal_for_package(package)),
+            }
+            if package in self.completed_packages:
+                m = package.morphology
+                state.update({
+                    'version_in_use': package.version_in_use,
+                    'dependencies': package.dependencies,
+                    'morphology': {
+                        'filename': m.filename,
+                        'repo_url': m.repo_url,
+                        'ref': m.ref,
+                        'named_ref': m.named_ref,
+                    },
+                })
+            return state
+
+        queued = set(to_process)
+        queue = list(to_process) + [
+            package for package in packages
+            if package not in self.completed_packages and
+            package not in queued]
+
+        state = {
+            'goal': [self.goal_kind, self.goal_name, self.goal_version],
+            'goals': [[goal.kind, goal.name, goal.version, goal.stratum_name]
+                      for goal in self.goals],
+            'packages': [package_state(package) for package in packages],
+            'build-dependency-edges': [
+                [index[dep], index[package]]
+                for dep, package in processed.edges()],
+            'queue': [index[package] for package in queue],
+            'failed': len(errors),
+            'version-constraints': [
+                [kind, name, required_by, spec]
+                for (kind, name), constraints in
+                sorted(self.version_constraints.iteritems())
+                for required_by, spec in constraints],
+        }
+
+        state_dir = os.path.dirname(self.state_file)
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        with morphlib.savefile.SaveFile(self.state_file, 'w') as f:
+            json.dump(state, f)
+
+    def _load_state(self, processed):
+        '''Restore the state saved by _save_state().
+
+        Fills in self.packages and the 'processed' graph, and returns the
+        processing queue.
+
+        '''
+        with open(self.state_file) as f:
+            state = json.load(f)
+
+        packages = []
+        to_process = []
+        for package_state in state['packages']:
+            package = baserockimport.package.Package(
+                package_state['kind'], package_state['name'],
+                package_state['version'])
+            package.set_is_build_dep(package_state['is_build_dep'])
+            self.packages.add(package)
+            self.package_goals[package] = self.goals[
+                package_state.get('goal', 0)]
+            packages.append(package)
+
+            if 'dependencies' in package_state and \
+                    self._restore_completed_package(package, package_state):
+                processed.add_node(package)
+                self.completed_packages.add(package)
+            else:
+                to_process.append(package)
+
+        # State saved by older versions lists the packages that require each
+        # one by name and version, rather than by index.
+        by_label = dict(('%s-%s' % (package.name, package.version), package)
+                        for package in packages)
+        for package, package_state in zip(packages, state['packages']):
+            package.required_by = [
+                packages[item] if isinstance(item, int) else by_label[item]
+                for item in package_state['required_by']
+                if isinstance(item, int) or item in by_label]
+
+        for dep_index, package_index in state['build-dependency-edges']:
+            processed.add_edge(packages[dep_index], packages[package_index])
+
+        for kind, name, required_by, spec in state.get(
+                'version-constraints', []):
+            self.version_constraints.setdefault((kind, name), []).append(
+                [required_by, spec])
+
+        # Keep the saved queue order. Packages whose chunk morphology has gone
+        # missing since the state was saved are processed first.
+        queue = [packages[i] for i in state['queue']]
+        queued = set(queue)
+        to_process = queue + [package for package in to_process
+                              if package not in queued]
 
         self.app.status(
-            '%s: Import of %s %s ended (took %i seconds)', end_displaytime,
-            self.goal_kind, self.goal_name, duration)
+            'Restored %i processed packages; %i packages to process, '
+            'including %i that failed last time',
+            len(self.completed_packages), len(to_process), state['failed'])
+        return to_process
+
+    def _restore_completed_package(self, package, package_state):
+        m_state = package_state['morphology']
+        with self.morph_set_lock:
+            morphology = self.morph_set.get_morphology(
+                None, None, m_state['filename'])
+
+        if morphology is None:
+            logging.debug('Chunk morphology %s for %s has gone missing, '
+                          'processing it again', m_state['filename'],
+                          package)
+            return False
+
+        morphology.repo_url = m_state['repo_url']
+        morphology.ref = m_state['ref']
+        morphology.named_ref = m_state['named_ref']
+        package.set_morphology(morphology)
+        with self.morph_set_lock:
+            self.morph_set.release_morphology(m_state['filename'])
+        package.set_version_in_use(package_state['version_in_use'])
+        package.set_dependencies(package_state['dependencies'])
+        return True
+
+    def _load_existing_stratum(self, goal):
+        '''Load the stratum morphology for a goal, for incremental mode.'''
+        filename = 'strata/%s.morph' % goal.stratum_name
+        with self.morph_set_lock:
+            stratum = self.morph_set.get_morphology(None, None, filename)
+
+        if stratum is None:
+            self.app.status('No existing stratum morph %s, so every package '
+                            'will be processed', filename)
+            return None
+
+        self.app.status('Updating the existing stratum morph %s', filename)
+        self.existing_chunk_entries.update(
+            (entry['morph'], entry) for entry in stratum['chunks']
+            if 'morph' in entry)
+        return stratum
+
+    def _stratum_entry_is_current(self, entry):
+        '''Return True if the ref of a chunk entry still has the same commit.
+
+        Only the local mirror of the source repo is checked, without using
+        the network, so this notices tags that were moved by a later run of
+        Lorry. With --update-existing, _mirror_sources() updates the mirror
+        before this is called. If there is no local mirror, the entry is
+        assumed to be current.
+
+        '''
+        repo = entry.get('repo', '')
+        if repo.startswith('upstream:'):
+            _, repopath = self._lorry_repo_path(repo[len('upstream:'):])
+        elif repo.startswith('file://'):
+            repopath = repo[len('file://'):]
+        else:
+            return True
+
+        if not os.path.exists(repopath):
+            return True
+
+        try:
+            commit = cliapp.runcmd(
+                ['git', 'rev-parse', '--verify',
+                 '%s^{commit}' % entry['unpetrify-ref']],
+                cwd=repopath).strip()
+        except cliapp.AppException:
+            return False
+        return commit == entry['ref']
+
+    def _restore_package_from_stratum(self, package):
+        '''Reuse the existing stratum's chunk entry for 'package'.
+
+        In incremental mode, a package is not processed again if the existing
+        stratum has a chunk for the same version, whose ref still has the same
+        commit, and its chunk morphology and dependency list are still on
+        disk. Returns True if the package was restored.
+
+        Whether a package can be restored is only worked out once, so this
+        can be called again for the same package. With --update-existing, it
+        must not be called before _mirror_sources() has updated the package's
+        mirror.
+
+        '''
+        if len(self.existing_strata) == 0 or package.version is None:
+            return False
+        if package not in self.restored_from_stratum:
+            self.restored_from_stratum[package] = \
+                self._restore_package_from_stratum_entry(package)
+        return self.restored_from_stratum[package]
+
+    def _restore_package_from_stratum_entry(self, package):
+        filename = self._chunk_morph_filename(package, package.version)
+        entry = self.existing_chunk_entries.get(filename)
+        if entry is None:
+            return False
+
+        if not self._stratum_entry_is_current(entry):
+            logging.debug('%s in the existing stratum has moved from commit '
+                          '%s, processing %s again', entry['unpetrify-ref'],
+                          entry['ref'], package)
+            return False
+
+        depends_path = self._dependency_list_path(package, package.version)
+        if not os.path.exists(depends_path):
+            logging.debug("Didn't find %s, processing %s again",
+                          depends_path, package)
+            return False
+
+        with self.morph_set_lock:
+            morphology = self.morph_set.get_morphology(None, None, filename)
+        if morphology is None:
+            logging.debug("Didn't find %s, processing %s again", filename,
+                          package)
+            return False
+
+        with open(depends_path) as f:
+            dependencies = json.load(f)
+
+        morphology.repo_url = entry['repo']
+        morphology.ref = entry['ref']
+        morphology.named_ref = entry['unpetrify-ref']
+        package.set_morphology(morphology)
+        with self.morph_set_lock:
+            self.morph_set.release_morphology(filename)
+        package.set_dependencies(dependencies)
+
+        self.app.status('%s %s: unchanged, using the existing chunk entry',
+                        package.name, package.version)
+        return True
+
+    def _lock_for_lorry(self, kind, name):
+        with self.lorry_locks_lock:
+            if (kind, name) not in self.lorry_locks:
+                self.lorry_locks[(kind, name)] = threading.Lock()
+            return self.lorry_locks[(kind, name)]
+
+    def _prepare_lorry(self, kind, name):
+        '''Start generating the lorry entry for a package in the background.
+
+        This is called when an extension reports a dependency, while it is
+        still running, so that the entry is usually ready by the time the
+        dependency is processed. Any error is ignored here: it happens again,
+        and is reported, when the dependency itself is processed.
+
+        '''
+        if self.lorry_pool is None or kind not in self.importers:
+            return
+
+        with self.lorry_locks_lock:
+            if (kind, name) in self.lorry_locks:
+                # Already being generated, or done.
+                return
+            self.lorry_locks[(kind, name)] = threading.Lock()
+        with self.lorry_set_lock:
+            if self.lorry_set.find_lorry_for_package(kind, name) is not None:
+                return
+
+        def prepare():
+            try:
+                self._find_or_create_lorry_file(kind, name)
+            except Exception as e:
+                logging.debug('Unable to prepare lorry entry for %s: %s',
+                              name, e)
+
+        self.lorry_pool.apply_async(prepare)
+
+    def _lock_for_repo(self, reponame):
+        with self.repo_locks_lock:
+            if reponame not in self.repo_locks:
+                self.repo_locks[reponame] = threading.Lock()
+            return self.repo_locks[reponame]
 
     def _process_package(self, package):
         '''Process a single package.'''
+        if self._restore_package_from_stratum(package):
+            return
+        source = self._fetch_package(package)
+        self._analyse_package(package, *source)
 
-        kind = package.kind
+    def _fetch_package(self, package):
+        '''Make the source code of a package available.
+
+        Returns the package's lorry entry, source repo and source URL, which
+        are passed on to _analyse_package().
+
+        This may be called from several worker threads at once, so any state
+        shared between packages must be protected by the appropriate lock.
+
+        '''
+        with self.profiler.phase('%s-%s' % (package.name, package.version),
+                                 'fetch package'):
+            error = self.early_errors.pop(package, None)
+            if error is not None:
+                raise error
+
+            lorry = self._find_or_create_lorry_file(
+                package.kind, package.name)
+
+            # Other packages may come from the same source repo.
+            with self._lock_for_repo(lorry.keys()[0]):
+                with self.profiler.phase(None, 'fetch source'):
+                    source_repo, url = self._fetch_or_update_source(
+                        lorry, package)
+
+        return lorry, source_repo, url
+
+    def _analyse_package(self, package, lorry, source_repo, url):
+        '''Generate the chunk morphology and dependencies of a package.
+
+        As for _fetch_package(), this may be called from several worker
+        threads at once.
+
+        '''
+        with self.profiler.phase('%s-%s' % (package.name, package.version),
+                                 'analyse package'):
+            # This all happens in the source repo's checkout, which other
+            # packages from the same repo may also need.
+            with self._lock_for_repo(lorry.keys()[0]):
+                self._analyse_package_source(package, lorry, source_repo, url)
+
+    def _analyse_package_source(self, package, lorry, source_repo, url):
         name = package.name
         version = package.version
 
-        # 1. Make the source code available.
-
-        lorry = self._find_or_create_lorry_file(kind, name)
-        source_repo, url = self._fetch_or_update_source(lorry)
+        # 1. Check out the wanted version of the source code.
 
-        checked_out_version, ref = self._checkout_source_version_for_package(
-            source_repo, package)
+        with self.profiler.phase(None, 'check out source'):
+            checkout, checked_out_version, ref = \
+                self._checkout_source_version_for_package(source_repo, package)
         package.set_version_in_use(checked_out_version)
 
-        repo_path = os.path.relpath(source_repo.dirname)
+        repo_path = os.path.relpath(checkout.dirname)
         if morphlib.git.is_valid_sha1(ref):
             self.app.status(
                 "%s %s: using %s commit %s", name, version, repo_path, ref)
         else:
             self.app.status(
                 "%s %s: using %s ref %s (commit %s)", name, version, repo_path,
-                ref, source_repo.resolve_ref_to_commit(ref))
+                ref, checkout.resolve_ref_to_commit(ref))
 
         # 2. Create a chunk morphology with build instructions.
 
         chunk_morph = self._find_or_create_chunk_morph(
-            kind, name, checked_out_version, source_repo, url, ref)
+            package, checked_out_version, checkout, url, ref)
 
         if self.app.settings['use-local-sources']:
             chunk_morph.repo_url = 'file://' + source_repo.dirname
@@ -230,11 +1090,13 @@ class ImportLoop(object):
             chunk_morph.repo_url = 'upstream:%s' % reponame
 
         package.set_morphology(chunk_morph)
+        with self.morph_set_lock:
+            self.morph_set.release_morphology(chunk_morph.filename)
 
         # 3. Calculate the dependencies of this package.
 
         dependencies = self._find_or_create_dependency_list(
-            kind, name, checked_out_version, source_repo)
+            package, checked_out_version, checkout)
 
         package.set_dependencies(dependencies)
 
@@ -261,67 +1123,122 @@ class ImportLoop(object):
     def _update_queue_and_graph_with_dependency(self, current_item, kind, name,
                                                 version, is_build_dep,
                                                 to_process, processed, errors):
-        failed_dep_package = find(
-            errors, lambda i: i.match(kind, name, version))
-        if failed_dep_package:
-            logging.debug(
-                "Ignoring %s as it failed earlier.", failed_dep_package)
-            return
-
-        dep_package = find(
-            processed, lambda i: i.match(kind, name, version))
+        dep_package = self._package_for_dependency(kind, name, version)
+        if self._resolves_versions_import_wide(kind):
+            # 'version' is a requirement specifier, such as '>=1.0,<2.0'.
+            # Every package that depends on this project shares one Package,
+            # whose version is chosen when it is taken from the queue.
+            self.version_constraints.setdefault((kind, name), []).append(
+                ['%s-%s' % (current_item.name, current_item.version), version])
+            version = None
 
         if dep_package is None:
-            # Not yet processed
-            queue_item = find(
-                to_process, lambda i: i.match(kind, name, version))
-            if queue_item is None:
-                queue_item = baserockimport.package.Package(
-                    kind, name, version)
-                to_process.append(queue_item)
-            dep_package = queue_item
-
+            # Not yet processed or queued
+            dep_package = baserockimport.package.Package(kind, name, version)
+            self.packages.add(dep_package)
+            self.package_goals[dep_package] = self._goal_for_package(
+                current_item)
+            to_process.append(dep_package)
+        elif dep_package in errors:
+            logging.debug("Not processing %s again as it failed earlier.",
+                          dep_package)
+
+        # This is recorded even for a package that failed, so that the error
+        # is reported for every goal that needs it. See run().
         dep_package.add_required_by(current_item)
 
         if is_build_dep or current_item.is_build_dep:
             # A runtime dep of a build dep becomes a build dep itself.
-            dep_package.set_is_build_dep(True)
             processed.add_edge(dep_package, current_item)
+            self._mark_as_build_dep(dep_package, processed, errors)
+
+    def _package_for_dependency(self, kind, name, version):
+        '''Return the Package for one of the dependencies of a package.'''
+        if self._resolves_versions_import_wide(kind):
+            # There is one package per project, and 'version' is a
+            # requirement specifier.
+            matches = self.packages.find(kind, name)
+            return matches[0] if len(matches) > 0 else None
+        else:
+            return self.packages.get(kind, name, version)
+
+    def _mark_as_build_dep(self, package, processed, errors):
+        '''Record that 'package' is needed to build another package.
+
+        Its runtime dependencies are then build dependencies too. Packages
+        that haven't been handled yet pass this on to their dependencies when
+        they are, but a package can be found to be a build dependency after
+        it was handled, so that its dependencies have to be updated here.
+        Otherwise the graph would depend on the order the packages were
+        processed in.
+
+        '''
+        to_mark = [package]
+        while len(to_mark) > 0:
+            package = to_mark.pop()
+            if package.is_build_dep:
+                continue
+            package.set_is_build_dep(True)
+            if package not in self.completed_packages:
+                continue
+
+            for kind, kind_deps in package.dependencies.iteritems():
+                runtime_deps = kind_deps['runtime-dependencies']
+                for name, version in runtime_deps.iteritems():
+                    dep_package = self._package_for_dependency(
+                        kind, name, version)
+                    if dep_package is None or dep_package in errors:
+                        continue
+                    processed.add_edge(dep_package, package)
+                    to_mark.append(dep_package)
 
     def _find_or_create_lorry_file(self, kind, name):
         # Note that the lorry file may already exist for 'name', but lorry
         # files are named for project name rather than package name. In this
         # case we will generate the lorry, and try to add it to the set, at
         # which point LorrySet will notice the existing one and merge the two.
-        lorry = self.lorry_set.find_lorry_for_package(kind, name)
-
-        if lorry is None:
-            lorry = self._generate_lorry_for_package(kind, name)
-
-            if len(lorry) != 1:
-                raise Exception(
-                    'Expected generated lorry file with one entry.')
-
-            lorry_filename = lorry.keys()[0]
-
-            if '/' in lorry_filename:
-                # We try to be a bit clever and guess that if there's a prefix
-                # in the name, e.g. 'ruby-gems/chef' then it should go in a
-                # mega-lorry file, such as ruby-gems.lorry.
-                parts = lorry_filename.split('/', 1)
-                lorry_filename = parts[0]
-
-            if lorry_filename == '':
-                raise cliapp.AppException(
-                    'Invalid lorry data for %s: %s' % (name, lorry))
+        # Only one thread generates the lorry entry for each package, and any
+        # others wait for it to finish. See _prepare_lorry().
+        with self._lock_for_lorry(kind, name):
+            # Entries that don't list their products, such as tarball lorries
+            # for Python packages, can't be found in the lorry set, but
+            # generating them again during the same import would give the
+            # same result.
+            if (kind, name) in self.generated_lorries:
+                return self.generated_lorries[(kind, name)]
+
+            with self.lorry_set_lock:
+                lorry = self.lorry_set.find_lorry_for_package(kind, name)
+
+            if lorry is None:
+                lorry = self._generate_lorry_for_package(kind, name)
+
+                if len(lorry) != 1:
+                    raise Exception(
+                        'Expected generated lorry file with one entry.')
+
+                lorry_filename = lorry.keys()[0]
+
+                if '/' in lorry_filename:
+                    # We try to be a bit clever and guess that if there's a
+                    # prefix in the name, e.g. 'ruby-gems/chef' then it should
+                    # go in a mega-lorry file, such as ruby-gems.lorry.
+                    parts = lorry_filename.split('/', 1)
+                    lorry_filename = parts[0]
+
+                if lorry_filename == '':
+                    raise cliapp.AppException(
+                        'Invalid lorry data for %s: %s' % (name, lorry))
+
+                with self.lorry_set_lock:
+                    self.lorry_set.add(lorry_filename, lorry)
+                self.generated_lorries[(kind, name)] = lorry
+            else:
+                lorry_filename = lorry.keys()[0]
+                logging.info('Found existing lorry file for %s: %s', name,
+                             lorry_filename)
 
-            self.lorry_set.add(lorry_filename, lorry)
-        else:
-            lorry_filename = lorry.keys()[0]
-            logging.info(
-                'Found existing lorry file for %s: %s', name, lorry_filename)
-
-        return lorry
+            return lorry
 
     def _generate_lorry_for_package(self, kind, name):
         tool = '%s.to_lorry' % kind
@@ -330,7 +1247,9 @@ class ImportLoop(object):
         extra_args = self.importers[kind]['extra_args']
         self.app.status(
             '%s: calling %s to generate lorry', name, tool)
-        lorry_text = run_extension(tool, extra_args + [name])
+        with self.profiler.phase(name, tool):
+            lorry_text = run_extension(
+                tool, extra_args + [name], self.extension_workers)
         try:
             lorry = json.loads(lorry_text)
         except ValueError:
@@ -343,63 +1262,378 @@ class ImportLoop(object):
             logging.debug(json.dumps(lorry))
             json.dump(lorry, f)
             f.flush()
-            cliapp.runcmd([
-                'lorry', '--working-area',
-                self.app.settings['lorry-working-dir'], '--pull-only',
-                '--bundle', 'never', '--tarball', 'never', f.name])
+            with self.profiler.phase(None, 'lorry'):
+                cliapp.runcmd([
+                    'lorry', '--working-area',
+                    self.app.settings['lorry-working-dir'], '--pull-only',
+                    '--bundle', 'never', '--tarball', 'never', f.name])
+
+    def _lorry_repo_path(self, lorry_name):
+        reponame = '_'.join(lorry_name.split('/'))
+        repopath = os.path.join(
+            self.app.settings['lorry-working-dir'], reponame, 'git')
+        return reponame, repopath
+
+    def _mirror_sources(self, packages):
+        '''Mirror the source repos of many packages with one Lorry run.
+
+        Each run of Lorry has a fixed cost for startup, locking the working
+        area and so on, which adds up when importing hundreds of packages. So
+        before the packages are processed, this collects the lorry entries for
+        every one of them that isn't mirrored yet, and runs Lorry on them all
+        at once. The repos are locked meanwhile, because other batches may be
+        mirrored, and other packages fetched, at the same time.
+
+        Nothing is reported if something goes wrong here. Any repo that Lorry
+        did not mirror is left for _fetch_or_update_source() to deal with when
+        its package is processed, so that the error gets reported for that
+        package.
+
+        '''
+        update_existing = self.app.settings['update-existing']
+
+        self._prefetch_lorry_metadata(packages)
+
+        pending = {}
+        for package in packages:
+            if package.version is None:
+                # Mirrored once its version has been chosen.
+                continue
+            if package in self.early_errors:
+                continue
+            if not update_existing and \
+                    self._restore_package_from_stratum(package):
+                # With --update-existing, the mirror is updated first, so
+                # that a tag which has moved upstream is noticed.
+                continue
+
+            try:
+                lorry = self._find_or_create_lorry_file(
+                    package.kind, package.name)
+            except BaserockImportException as e:
+                self.early_errors[package] = e
+                continue
+
+            lorry_name, lorry_entry = lorry.items()[0]
+            reponame, repopath = self._lorry_repo_path(lorry_name)
+            if reponame in self.mirrored_repos:
+                continue
+            if os.path.exists(repopath):
+                if not update_existing:
+                    continue
+                if self._source_is_fresh(reponame, package):
+                    continue
+            pending[lorry_name] = lorry_entry
+
+        if len(pending) == 0:
+            return
+
+        lorry_names = sorted(pending.iterkeys())
+        repos = dict((name, self._lorry_repo_path(name))
+                     for name in lorry_names)
+
+        # Locks are always taken in this order, so two batches can't each
+        # wait for a lock that the other one holds.
+        locks = [self._lock_for_repo(name) for name in lorry_names]
+        for lock in locks:
+            lock.acquire()
+        try:
+            # Another batch may have mirrored some of them in the meantime.
+            for name in lorry_names:
+                if repos[name][0] in self.mirrored_repos:
+                    del pending[name]
+            if len(pending) == 0:
+                return
+            lorry_names = sorted(pending.iterkeys())
+
+            already_lorried = set(
+                name for name, (_, repopath) in repos.iteritems()
+                if os.path.exists(repopath))
+
+            self.app.status('Lorrying %i repositories', len(lorry_names))
+            try:
+                with self.profiler.phase(', '.join(lorry_names),
+                                         'mirror sources'):
+                    self._run_lorry(pending)
+                succeeded = True
+            except cliapp.AppException as e:
+                logging.debug('Lorry failed for one or more of %s: %s',
+                              ', '.join(lorry_names), e)
+                succeeded = False
+
+            # If Lorry failed we can only be sure that it worked for repos
+            # that exist now and didn't before.
+            for name, (reponame, repopath) in repos.iteritems():
+                if succeeded or (name not in already_lorried and
+                                 os.path.exists(repopath)):
+                    self.mirrored_repos.add(reponame)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _prefetch_lorry_metadata(self, packages):
+        '''Fetch what the lorry entries of many packages need, all at once.
+
+        Some to_lorry extensions can fetch the metadata of many packages
+        concurrently into their cache when run with --prefetch, such as
+        rubygems.to_lorry. This is done for the packages that have no lorry
+        entry yet before the entries are generated one by one, so that each
+        one doesn't wait for the network in turn. Nothing is reported if it
+        fails.
+
+        '''
+        names = collections.defaultdict(set)
+        for package in packages:
+            kind = package.kind
+            importer = self.importers.get(kind)
+            if importer is None or \
+                    not importer['kwargs'].get('prefetch_lorries'):
+                continue
+            if package in self.early_errors:
+                continue
+            if not self.app.settings['update-existing'] and \
+                    self._restore_package_from_stratum(package):
+                continue
+            with self.lorry_locks_lock:
+                if (kind, package.name) in self.lorry_locks or \
+                        (kind, package.name) in self.prefetched_lorries:
+                    # Already being generated, done or prefetched.
+                    continue
+            with self.lorry_set_lock:
+                if self.lorry_set.find_lorry_for_package(
+                        kind, package.name) is not None:
+                    continue
+            names[kind].add(package.name)
+
+        for kind, kind_names in sorted(names.iteritems()):
+            if len(kind_names) < 2:
+                continue
+            with self.lorry_locks_lock:
+                self.prefetched_lorries.update(
+                    (kind, name) for name in kind_names)
+            tool = '%s.to_lorry' % kind
+            extra_args = self.importers[kind]['extra_args']
+            logging.debug('Prefetching metadata for %i packages with %s',
+                          len(kind_names), tool)
+            with self.profiler.phase(None, '%s --prefetch' % tool):
+                try:
+                    run_extension(
+                        tool, extra_args + ['--prefetch'] + sorted(kind_names),
+                        self.extension_workers)
+                except BaserockImportException as e:
+                    logging.debug('Prefetching with %s failed: %s', tool, e)
+
+    def _resolve_versions(self, packages):
+        '''Choose a version for each package that doesn't have one yet.
+
+        These are packages of a kind whose versions are resolved import-wide.
+        Each one gets the newest version that satisfies every requirement on
+        it that has been found so far, and requirements that are found after
+        that are checked by _check_import_wide_versions() once the queue is
+        empty. The '<kind>.resolve' extension is run once for all of them.
+
+        Errors are recorded in self.early_errors.
+
+        '''
+        unresolved = {}
+        for package in packages:
+            if package.version is None:
+                unresolved.setdefault(package.kind, {})[package.name] = package
+
+        for kind, packages_by_name in sorted(unresolved.iteritems()):
+            projects = dict(
+                (name, {'constraints': self.version_constraints.get(
+                    (kind, name), [])})
+                for name in packages_by_name)
+            try:
+                results = self._run_resolver(kind, projects)
+            except BaserockImportException as e:
+                for package in packages_by_name.itervalues():
+                    self.early_errors[package] = e
+                continue
+
+            for name, package in sorted(packages_by_name.iteritems()):
+                result = results[name]
+                if 'error' in result:
+                    self.early_errors[package] = BaserockImportException(
+                        result['error'])
+                else:
+                    logging.debug('Chose %s %s for the whole import', name,
+                                  result['version'])
+                    self.packages.set_version(package, result['version'])
+
+    def _check_import_wide_versions(self, errors):
+        '''Check the chosen versions against every requirement on them.
+
+        A requirement found after a project's version was chosen may not be
+        satisfied by it, in which case the project is recorded as failed. If
+        the check itself fails, every project it was checking is recorded as
+        failed.
+
+        '''
+        to_check = {}
+        for package in self.completed_packages:
+            if (self._resolves_versions_import_wide(package.kind) and
+                    package not in errors and package.version != 'master'):
+                to_check.setdefault(package.kind, {})[package.name] = package
+
+        for kind, packages_by_name in sorted(to_check.iteritems()):
+            projects = dict(
+                (name, {'version': package.version,
+                        'constraints': self.version_constraints.get(
+                            (kind, name), [])})
+                for name, package in packages_by_name.iteritems())
+            self.app.status('Checking the versions of %i %s packages against '
+                            'every requirement on them', len(projects), kind)
+            try:
+                results = self._run_resolver(kind, projects)
+            except BaserockImportException as e:
+                self.app.status('%s', e, error=True)
+                for package in packages_by_name.itervalues():
+                    errors[package] = e
+                continue
+
+            for name, package in sorted(packages_by_name.iteritems()):
+                if 'error' in results[name]:
+                    error = BaserockImportException(results[name]['error'])
+                    self.app.status('%s', error, error=True)
+                    errors[package] = error
+
+    def _run_resolver(self, kind, projects):
+        tool = '%s.resolve' % kind
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            json.dump(projects, f)
+            f.flush()
+            with self.profiler.phase(None, tool):
+                text = run_extension(tool, [f.name], self.extension_workers)
+        try:
+            return json.loads(text)
+        except ValueError:
+            raise BaserockImportException(
+                'Invalid output from %s: %s' % (tool, text))
+
+    def _checkout_path(self, reponame):
+        return os.path.join(self.app.settings['checkouts-dir'], reponame)
+
+    def _worktrees_path(self, reponame):
+        return os.path.join(
+            os.path.abspath(self.app.settings['checkouts-dir']),
+            '%s.worktrees' % reponame)
+
+    def _use_worktrees(self):
+        return self.app.settings['checkout-mode'] == 'worktree'
+
+    def _source_is_fresh(self, reponame, package):
+        '''Return True if the source repo for 'package' needn't be fetched.
+
+        That is the case when the checkout was updated less than
+        'fetch-max-age' seconds ago, and one of the refs that
+        _checkout_source_version_for_package() looks for exists in it
+        already.
+
+        '''
+        last_fetch = self.fetch_times.get(reponame)
+        if last_fetch is None:
+            return False
+        if time.time() - last_fetch > self.app.settings['fetch-max-age']:
+            return False
+
+        if self._use_worktrees():
+            # Worktrees see the refs of the Lorry mirror directly.
+            repopath = os.path.join(
+                self.app.settings['lorry-working-dir'], reponame, 'git')
+            if not os.path.exists(repopath):
+                return False
+            repo = baserockimport.gitmirror.GitMirror(
+                repopath, self._worktrees_path(reponame))
+        else:
+            checkoutpath = self._checkout_path(reponame)
+            if not os.path.exists(checkoutpath):
+                return False
+            repo = morphlib.gitdir.GitDirectory(checkoutpath)
+
+        return any(repo.ref_exists(ref)
+                   for ref in self._possible_refs_for_package(package))
 
-    def _fetch_or_update_source(self, lorry):
+    def _fetch_or_update_source(self, lorry, package):
         assert len(lorry) == 1
         lorry_name, lorry_entry = lorry.items()[0]
 
         url = lorry_entry['url']
-        reponame = '_'.join(lorry_name.split('/'))
-        repopath = os.path.join(
-            self.app.settings['lorry-working-dir'], reponame, 'git')
+        reponame, repopath = self._lorry_repo_path(lorry_name)
 
-        checkoutpath = os.path.join(
-            self.app.settings['checkouts-dir'], reponame)
+        checkoutpath = self._checkout_path(reponame)
 
         try:
             already_lorried = os.path.exists(repopath)
-            if already_lorried:
+            mirrored_in_batch = reponame in self.mirrored_repos
+            fresh = (not mirrored_in_batch and
+                     self._source_is_fresh(reponame, package))
+            if mirrored_in_batch:
+                logging.debug('Already mirrored %s during this run', url)
+            elif fresh:
+                logging.debug('Not fetching %s, it was fetched recently and '
+                              'has the wanted ref already', url)
+            elif already_lorried:
                 if self.app.settings['update-existing']:
                     self.app.status('Updating lorry of %s', url)
                     self._run_lorry(lorry)
+                    self.mirrored_repos.add(reponame)
             else:
                 self.app.status('Lorrying %s', url)
                 self._run_lorry(lorry)
-
-            if os.path.exists(checkoutpath):
+                self.mirrored_repos.add(reponame)
+
+            if self._use_worktrees():
+                repo = baserockimport.gitmirror.GitMirror(
+                    repopath, self._worktrees_path(reponame))
+                if not fresh:
+                    self.fetch_times[reponame] = time.time()
+            elif os.path.exists(checkoutpath):
                 repo = morphlib.gitdir.GitDirectory(checkoutpath)
-                repo.update_remotes()
+                if not fresh:
+                    repo.update_remotes()
+                    # Tags that have moved to another commit in the mirror
+                    # are left alone by that, so they are fetched again.
+                    cliapp.runcmd(['git', 'fetch', 'origin',
+                                   '+refs/tags/*:refs/tags/*'],
+                                  cwd=checkoutpath)
+                    self.fetch_times[reponame] = time.time()
             else:
-                if already_lorried:
+                if already_lorried and not mirrored_in_batch:
                     logging.warning(
                         'Expected %s to exist, but will recreate it',
                         checkoutpath)
                 cliapp.runcmd(['git', 'clone', repopath, checkoutpath])
+                self.fetch_times[reponame] = time.time()
                 repo = morphlib.gitdir.GitDirectory(checkoutpath)
         except cliapp.AppException as e:
             raise BaserockImportException(e.msg.rstrip())
 
         return repo, url
 
-    def _checkout_source_version_for_package(self, source_repo, package):
+    def _possible_refs_for_package(self, package):
         # FIXME: we need to be a bit smarter than this. Right now we assume
         # that 'version' is a valid Git ref.
-        name = package.name
-        version = package.version
-
-        possible_names = [
-            version,
-            'v%s' % version,
-            '%s-%s' % (name, version)
+        return [
+            package.version,
+            'v%s' % package.version,
+            '%s-%s' % (package.name, package.version)
         ]
 
-        for tag_name in possible_names:
+    def _checkout_source_version_for_package(self, source_repo, package):
+        '''Check out the source code of 'package'.
+
+        Returns the GitDirectory where the code is checked out, the version
+        that was used and the ref that was checked out. In 'worktree' checkout
+        mode, the GitDirectory is a worktree for that ref, otherwise it is
+        'source_repo' itself.
+
+        '''
+        version = package.version
+
+        for tag_name in self._possible_refs_for_package(package):
             if source_repo.ref_exists(tag_name):
-                source_repo.checkout(tag_name)
                 ref = tag_name
                 break
         else:
@@ -407,31 +1641,53 @@ class ImportLoop(object):
                 logging.warning(
                     "Couldn't find tag %s in repo %s. Using 'master'.",
                     tag_name, source_repo)
-                source_repo.checkout('master')
                 ref = version = 'master'
             else:
                 raise BaserockImportException(
                     'Could not find ref for %s.' % package)
 
-        return version, ref
+        try:
+            if self._use_worktrees():
+                checkout = source_repo.checkout(ref)
+            else:
+                source_repo.checkout(ref)
+                checkout = source_repo
+        except cliapp.AppException as e:
+            raise BaserockImportException(e.msg.rstrip())
+
+        return checkout, version, ref
+
+    def _goal_for_package(self, package):
+        '''Return the goal whose stratum directory holds 'package'.'''
+        return self.package_goals.get(package, self.goals[0])
 
-    def _find_or_create_chunk_morph(self, kind, name, version, source_repo,
+    def _chunk_morph_filename(self, package, version):
+        return 'strata/%s/%s-%s.morph' % (
+            self._goal_for_package(package).stratum_name, package.name,
+            version)
+
+    def _find_or_create_chunk_morph(self, package, version, source_repo,
                                     repo_url, named_ref):
-        morphology_filename = 'strata/%s/%s-%s.morph' % (
-            self.goal_name, name, version)
+        kind = package.kind
+        name = package.name
+        morphology_filename = self._chunk_morph_filename(package, version)
         sha1 = source_repo.resolve_ref_to_commit(named_ref)
 
         def generate_morphology():
             morphology = self._generate_chunk_morph_for_package(
                 source_repo, kind, name, version, morphology_filename)
-            self.morph_set.save_morphology(morphology_filename, morphology)
+            with self.morph_set_lock:
+                self.morph_set.save_morphology(morphology_filename, morphology)
             return morphology
 
+        def get_morphology(repo_url, ref, filename):
+            with self.morph_set_lock:
+                return self.morph_set.get_morphology(repo_url, ref, filename)
+
         if self.app.settings['update-existing']:
             morphology = generate_morphology()
         else:
-            morphology = self.morph_set.get_morphology(
-                repo_url, sha1, morphology_filename)
+            morphology = get_morphology(repo_url, sha1, morphology_filename)
 
             if morphology is None:
                 # Existing chunk morphologies loaded from disk don't contain
@@ -440,8 +1696,7 @@ class ImportLoop(object):
                 # set this info.
                 logging.debug("Didn't find morphology for %s|%s|%s", repo_url,
                               sha1, morphology_filename)
-                morphology = self.morph_set.get_morphology(
-                    None, None, morphology_filename)
+                morphology = get_morphology(None, None, morphology_filename)
 
                 if morphology is None:
                     logging.debug("Didn't find morphology for None|None|%s",
@@ -458,27 +1713,29 @@ class ImportLoop(object):
                                           version, filename):
         tool = '%s.to_chunk' % kind
 
-        if kind not in self.importers:
-            raise Exception('Importer for %s was not enabled.' % kind)
-        extra_args = self.importers[kind]['extra_args']
-
-        self.app.status(
-            '%s %s: calling %s to generate chunk morph', name, version, tool)
-
-        args = extra_args + [source_repo.dirname, name]
-        if version != 'master':
-            args.append(version)
-        text = run_extension(tool, args)
+        text = self._run_extension_for_package(
+            tool, source_repo, kind, name, version, 'generate chunk morph',
+            use_result_cache=True)
 
         return self.morphloader.load_from_string(text, filename)
 
-    def _find_or_create_dependency_list(self, kind, name, version,
-                                        source_repo):
-        depends_filename = 'strata/%s/%s-%s.foreign-dependencies' % (
-            self.goal_name, name, version)
-        depends_path = os.path.join(
+    def _dependency_list_path(self, package, version):
+        if self._resolves_versions_import_wide(package.kind):
+            # These list requirement specifiers rather than versions.
+            suffix = 'foreign-requirements'
+        else:
+            suffix = 'foreign-dependencies'
+        depends_filename = 'strata/%s/%s-%s.%s' % (
+            self._goal_for_package(package).stratum_name, package.name,
+            version, suffix)
+        return os.path.join(
             self.app.settings['definitions-dir'], depends_filename)
 
+    def _find_or_create_dependency_list(self, package, version, source_repo):
+        kind = package.kind
+        name = package.name
+        depends_path = self._dependency_list_path(package, version)
+
         def calculate_dependencies():
             dependencies = self._calculate_dependencies_for_package(
                 source_repo, kind, name, version, depends_path)
@@ -501,65 +1758,250 @@ class ImportLoop(object):
                                             version, filename):
         tool = '%s.find_deps' % kind
 
+        dependencies = {
+            kind: {'build-dependencies': {}, 'runtime-dependencies': {}}
+        }
+
+        def report_record(record):
+            if record.get('type') != 'dependency':
+                logging.debug('Ignoring record from %s: %s', tool, record)
+                return
+
+            if record['build-dependency']:
+                field = 'build-dependencies'
+            else:
+                field = 'runtime-dependencies'
+            dep_kind = record['kind']
+            kind_deps = dependencies.setdefault(
+                dep_kind,
+                {'build-dependencies': {}, 'runtime-dependencies': {}})
+            kind_deps[field][record['name']] = record['version']
+
+            self._prepare_lorry(dep_kind, record['name'])
+
+        # When versions are resolved import-wide, the extension only reports
+        # the requirement specifiers it reads from the source tree, so its
+        # output can be cached. Otherwise it depends on the releases that
+        # the package index has at the time.
+        text = self._run_extension_for_package(
+            tool, source_repo, kind, name, version, 'calculate dependencies',
+            report_record=report_record,
+            use_result_cache=self._resolves_versions_import_wide(kind))
+
+        if text.strip():
+            # The extension wrote its dependencies as one document instead.
+            dependencies = json.loads(text)
+        return dependencies
+
+    def _run_extension_for_package(self, tool, source_repo, kind, name,
+                                   version, purpose, report_record=None,
+                                   use_result_cache=False):
+        '''Run 'tool' on the source code of a package, or reuse its output.
+
+        If 'use_result_cache' is True, the output is looked up in the result
+        cache (see the 'result-cache' setting), unless the checkout has
+        uncommitted changes to tracked files, in which case it doesn't
+        correspond to any commit, or the importer was enabled with
+        'cache_results' set to False. This is only right for tools whose
+        output depends on nothing but the source tree and their arguments.
+
+        With --update-existing, cached output is not used, but the new output
+        still replaces it in the cache.
+
+        Records in the output are passed to 'report_record', as for
+        run_extension(), whether they come from the extension or the cache.
+
+        '''
         if kind not in self.importers:
             raise Exception('Importer for %s was not enabled.' % kind)
         extra_args = self.importers[kind]['extra_args']
 
+        version_args = [version] if version != 'master' else []
+        args = extra_args + [source_repo.dirname, name] + version_args
+
+        key = None
+        if (self.result_cache is not None and use_result_cache and
+                self.importers[kind]['kwargs'].get('cache_results', True)):
+            try:
+                dirty = cliapp.runcmd(
+                    ['git', 'status', '--porcelain', '--untracked-files=no'],
+                    cwd=source_repo.dirname).strip()
+                commit = source_repo.resolve_ref_to_commit('HEAD')
+            except cliapp.AppException as e:
+                raise BaserockImportException(e.msg.rstrip())
+
+            if dirty:
+                logging.debug('Not using result cache for %s: %s has '
+                              'uncommitted changes', tool, source_repo.dirname)
+            else:
+                key_args = extra_args + [name] + version_args
+                key = self.result_cache.key(
+                    os.path.join(extensions_dir(), tool), commit, key_args)
+
+            if key is not None and not self.app.settings['update-existing']:
+                text = self.result_cache.get(key)
+                if text is not None:
+                    self.app.status(
+                        '%s %s: using cached output of %s to %s', name,
+                        version, tool, purpose)
+                    if report_record is not None:
+                        text = '\n'.join(
+                            dispatch_records(text.split('\n'), report_record,
+                                             'cached output of %s' % tool))
+                    return text
+
         self.app.status(
-            '%s %s: calling %s to calculate dependencies', name, version, tool)
+            '%s %s: calling %s to %s', name, version, tool, purpose)
+        # The records are cached along with the rest of the output.
+        records = []
 
-        args = extra_args + [source_repo.dirname, name]
-        if version != 'master':
-            args.append(version)
-        text = run_extension(tool, args)
+        def keep_and_report_record(record):
+            if key is not None:
+                records.append(RECORD_SEPARATOR + json.dumps(record))
+            report_record(record)
 
-        return json.loads(text)
+        with self.profiler.phase(None, tool):
+            text = run_extension(
+                tool, args, self.extension_workers,
+                keep_and_report_record if report_record else None)
 
-    def _sort_chunks_by_build_order(self, graph):
-        order = reversed(sorted(graph.nodes()))
-        try:
-            return networkx.topological_sort(graph, nbunch=order)
-        except networkx.NetworkXUnfeasible:
-            # Cycle detected!
-            loop_subgraphs = networkx.strongly_connected_component_subgraphs(
-                graph, copy=False)
-            all_loops_str = []
-            for graph in loop_subgraphs:
-                if graph.number_of_nodes() > 1:
-                    loops_str = '->'.join(str(node) for node in graph.nodes())
-                    all_loops_str.append(loops_str)
-            raise cliapp.AppException(
-                'One or more cycles detected in build graph: %s' %
-                (', '.join(all_loops_str)))
+        if key is not None:
+            self.result_cache.put(key, '\n'.join(records + [text]))
+        return text
+
+    def _build_levels(self, graph):
+        '''Group the chunks in 'graph' into levels that can build in parallel.
 
-    def _maybe_generate_stratum(self, graph, errors, goal_name):
+        See baserockimport.buildorder.build_levels().
+
+        '''
+        return baserockimport.buildorder.build_levels(
+            graph, sort_key=lambda package: (package.name, package.version),
+            label=lambda package: '%s-%s' % (package.name, package.version))
+
+    def _chunk_names_by_level(self, levels):
+        '''Return the 'x-build-levels' field of the stratum.
+
+        This lists the names of the chunks at each build level, so that the
+        chunks in one level can be built at the same time.
+
+        '''
+        result = []
+        for level in levels:
+            names = [package.morphology.name for package in level
+                     if package.morphology is not None]
+            if len(names) > 0:
+                result.append(names)
+        return result
+
+    def _sort_chunks_keeping_order(self, graph, position):
+        '''Sort the chunks by build order, keeping an existing order.
+
+        'position' gives the index of each chunk in the existing stratum, by
+        chunk name. Those chunks stay in the same order unless something
+        they build-depend on has to be moved before them. A new chunk goes
+        just before the first existing chunk that build-depends on it, or at
+        the end if there isn't one.
+
+        '''
+        def chunk_name(package):
+            if package.morphology is None:
+                return package.name
+            return package.morphology.name
+
+        def sort_key(package):
+            name = chunk_name(package)
+            if name in position:
+                return (position[name], 1, name)
+            dependents = [position[chunk_name(dependent)]
+                          for dependent in graph.successors(package)
+                          if chunk_name(dependent) in position]
+            return (min(dependents) if dependents else len(position), 0, name)
+
+        return baserockimport.buildorder.prioritised_order(
+            graph, sort_key,
+            label=lambda package: '%s-%s' % (package.name, package.version))
+
+    def _dependencies_by_package(self):
+        '''Return the packages that each package was found to require.'''
+        dependencies = collections.defaultdict(list)
+        for package in self.packages:
+            for item in package.required_by:
+                dependencies[item].append(package)
+        return dependencies
+
+    def _packages_needed_by(self, goal, dependencies):
+        '''Return the set of packages that 'goal' needs, including itself.'''
+        needed = set([goal.package])
+        to_visit = [goal.package]
+        while len(to_visit) > 0:
+            package = to_visit.pop()
+            for dependency in dependencies[package]:
+                if dependency not in needed:
+                    needed.add(dependency)
+                    to_visit.append(dependency)
+        return needed
+
+    def _maybe_generate_stratum(self, graph, errors, goal):
         filename = os.path.join(
             self.app.settings['definitions-dir'], 'strata', '%s.morph' %
-            goal_name)
+            goal.stratum_name)
         update_existing = self.app.settings['update-existing']
+        existing_stratum = self.existing_strata.get(goal.stratum_name)
+
+        if existing_stratum is not None:
+            generate_stratum = self._update_stratum
+        else:
+            generate_stratum = self._generate_stratum
 
         if self.app.settings['force-stratum-generation']:
-            self._generate_stratum(
-                graph, goal_name, filename, ignore_errors=True)
+            generate_stratum(graph, goal, filename, ignore_errors=True)
         elif len(errors) > 0:
             self.app.status(
-                '\nErrors encountered, not generating a stratum morphology.')
+                '\nErrors encountered, not generating a stratum morphology '
+                'for %s.' % goal.stratum_name)
             self.app.status(
                 'See the README files for guidance.')
+        elif existing_stratum is not None:
+            generate_stratum(graph, goal, filename)
         elif os.path.exists(filename) and not update_existing:
             self.app.status(
                 msg='Found stratum morph for %s at %s, not overwriting' %
-                (goal_name, filename))
+                (goal.stratum_name, filename))
         else:
-            self._generate_stratum(graph, goal_name, filename)
+            generate_stratum(graph, goal, filename)
 
-    def _generate_stratum(self, graph, goal_name, filename,
-                          ignore_errors=False):
-        self.app.status(msg='Generating stratum morph for %s' % goal_name)
+    def _chunk_entry(self, package):
+        '''Return the stratum's chunk entry for 'package'.'''
+        m = package.morphology
+
+        def format_build_dep(kind, name, version):
+            dep_package = self._package_for_dependency(kind, name, version)
+            return '%s-%s' % (name, dep_package.version_in_use)
+
+        build_depends = []
+        for kind in self.importers:
+            build_deps = m.build_dependencies.get(kind, {})
+            for name, version in build_deps.iteritems():
+                build_depends.append(format_build_dep(kind, name, version))
+
+        return {
+            'name': m.name,
+            'repo': m.repo_url,
+            'ref': m.ref,
+            'unpetrify-ref': m.named_ref,
+            'morph': m.filename,
+            'build-depends': build_depends
+        }
+
+    def _generate_stratum(self, graph, goal, filename, ignore_errors=False):
+        self.app.status(
+            msg='Generating stratum morph for %s' % goal.stratum_name)
 
         chunk_entries = []
 
-        for package in self._sort_chunks_by_build_order(graph):
+        levels = self._build_levels(graph)
+        for package in [package for level in levels for package in level]:
             m = package.morphology
 
             if m is None:
@@ -570,46 +2012,90 @@ class ImportLoop(object):
                 else:
                     raise cliapp.AppException('No morphology for %s' % package)
 
-            def format_build_dep(kind, name, version):
-                dep_package = find(
-                    graph, lambda p: p.match(kind, name, version))
-                return '%s-%s' % (name, dep_package.version_in_use)
-
-            def get_build_deps(morphology, kind):
-                field = 'x-build-dependencies-%s' % kind
-                return morphology.get(field, {})
-
-            build_depends = []
-            for kind in self.importers:
-                for name, version in get_build_deps(m, kind).iteritems():
-                    build_depends.extend(
-                        format_build_dep(kind, name, version))
-
-            entry = {
-                'name': m['name'],
-                'repo': m.repo_url,
-                'ref': m.ref,
-                'unpetrify-ref': m.named_ref,
-                'morph': m.filename,
-                'build-depends': build_depends
-            }
-            chunk_entries.append(entry)
+            chunk_entries.append(self._chunk_entry(package))
 
-        kwargs = self.importers[kind]['kwargs']
+        kwargs = self.importers[goal.kind]['kwargs']
 
         stratum_build_depends = (
             [{'morph': stratum} for stratum in kwargs['strata']]
                 if 'strata' in kwargs else [])
 
-        stratum_name = goal_name
         stratum = {
-            'name': stratum_name,
+            'name': goal.stratum_name,
             'kind': 'stratum',
             'description': 'Autogenerated by Baserock import tool',
             'build-depends': stratum_build_depends,
             'chunks': chunk_entries,
+            'x-build-levels': self._chunk_names_by_level(levels),
         }
 
         morphology = morphlib.morphology.Morphology(stratum)
         morphology.filename = filename
         self.morphloader.save_to_file(filename, morphology)
+
+    def _update_stratum(self, graph, goal, filename, ignore_errors=False):
+        '''Update the existing stratum with the chunks in 'graph'.
+
+        Entries for chunks that haven't changed are kept as they are,
+        including any fields that were added to them by hand. The rest of
+        the stratum is kept too. Chunks that nothing depends on any more are
+        removed.
+
+        '''
+        self.app.status(
+            msg='Updating stratum morph for %s' % goal.stratum_name)
+
+        existing_stratum = self.existing_strata[goal.stratum_name]
+        old_chunks = existing_stratum['chunks']
+        old_entries = dict((entry['morph'], entry) for entry in old_chunks
+                           if 'morph' in entry)
+        position = dict((entry['name'], i)
+                        for i, entry in enumerate(old_chunks))
+
+        chunk_entries = []
+        counts = collections.Counter()
+        for package in self._sort_chunks_keeping_order(graph, position):
+            if package.morphology is None:
+                if ignore_errors:
+                    logging.warn('Ignoring %s because there is no chunk '
+                                 'morphology.', package)
+                    continue
+                else:
+                    raise cliapp.AppException('No morphology for %s' % package)
+
+            entry = self._chunk_entry(package)
+            old_entry = old_entries.get(entry['morph'])
+            if old_entry is None:
+                counts['added'] += 1
+            else:
+                if (set(entry['build-depends']) ==
+                        set(old_entry.get('build-depends', []))):
+                    entry['build-depends'] = old_entry['build-depends']
+                new_entry = dict(old_entry)
+                new_entry.update(entry)
+                if new_entry == old_entry:
+                    counts['unchanged'] += 1
+                else:
+                    counts['changed'] += 1
+                entry = new_entry
+            chunk_entries.append(entry)
+
+        kept = set(entry['morph'] for entry in chunk_entries)
+        for entry in old_chunks:
+            if entry.get('morph') not in kept:
+                logging.info('Removing %s from the stratum', entry['name'])
+                counts['removed'] += 1
+
+        stratum = morphlib.morphology.Morphology(existing_stratum)
+        stratum['chunks'] = chunk_entries
+        stratum['x-build-levels'] = self._chunk_names_by_level(
+            self._build_levels(graph))
+        stratum.filename = os.path.relpath(filename, self.morph_set.path)
+        with self.morph_set_lock:
+            self.morph_set.release_morphology(stratum.filename)
+            self.morph_set.save_morphology(stratum.filename, stratum)
+
+        self.app.status(
+            'Stratum morph for %s: %i chunks unchanged, %i changed, %i '
+            'added, %i removed', goal.stratum_name, counts['unchanged'],
+            counts['changed'], counts['added'], counts['removed'])
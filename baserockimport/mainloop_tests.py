@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+from baserockimport.mainloop import BaserockImportException, ImportLoop
+
+
+class FakeApp(object):
+
+    def __init__(self, tempdir):
+        self.settings = {
+            'lorries-dir': os.path.join(tempdir, 'lorries'),
+            'definitions-dir': os.path.join(tempdir, 'definitions'),
+            'checkouts-dir': os.path.join(tempdir, 'checkouts'),
+            'lorry-working-dir': os.path.join(tempdir, 'lorry-working-dir'),
+            'cache-dir': os.path.join(tempdir, 'cache'),
+            'result-cache': False,
+            'result-cache-dir': '',
+            'force-stratum-generation': False,
+            'update-existing': False,
+            'incremental': False,
+            'use-local-sources': False,
+            'use-master-if-no-tag': False,
+            'jobs': 1,
+            'fetch-jobs': 0,
+            'analysis-jobs': 0,
+            'pypi-cache-ttl': 0,
+            'rubygems-cache-ttl': 0,
+            'pypi-index': '',
+            'python-resolution': 'per-package',
+            'persistent-extensions': False,
+            'checkpoint-interval': 60,
+            'resume': False,
+            'fetch-max-age': 0,
+            'checkout-mode': 'clone',
+            'profile-dir': '',
+            'profile-top': 0,
+        }
+
+    def status(self, msg, *args, **kwargs):
+        pass
+
+
+class BatchImportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_import(self, goals, dependencies, failures):
+        '''Import 'goals' without fetching or analysing anything.
+
+        'dependencies' maps each package name to the names of its runtime
+        dependencies, and the packages in 'failures' fail to be processed.
+        Returns the names of the packages in each goal's stratum, and of the
+        ones with errors.
+
+        '''
+        loop = ImportLoop(FakeApp(self.tempdir), 'python', goals[0], '1.0')
+        for goal in goals[1:]:
+            loop.add_goal('python', goal, '1.0')
+        loop.enable_importer('python')
+
+        def process_package(package):
+            if package.name in failures:
+                raise BaserockImportException('%s failed' % package.name)
+            morphology = morphlib.morphology.Morphology(
+                {'name': package.name, 'kind': 'chunk'})
+            morphology.filename = '%s.morph' % package.name
+            morphology.repo_url = morphology.ref = morphology.named_ref = None
+            package.set_morphology(morphology)
+            package.set_version_in_use(package.version)
+
+            runtime_deps = dict((name, '1.0') for name in
+                                dependencies.get(package.name, []))
+            package.set_dependencies({
+                'python': {'build-dependencies': {},
+                           'runtime-dependencies': runtime_deps}})
+
+        strata = {}
+
+        def generate_stratum(graph, errors, goal):
+            strata[goal.stratum_name] = (
+                sorted(package.name for package in graph),
+                sorted(package.name for package in errors))
+
+        loop._mirror_sources = lambda packages: None
+        loop._process_package = process_package
+        loop._maybe_generate_stratum = generate_stratum
+        loop.run()
+        return strata
+
+    def test_shared_dependency(self):
+        strata = self.run_import(['a', 'b'], {'a': ['c'], 'b': ['c', 'd']},
+                                 failures=[])
+
+        self.assertEqual(strata, {'a': (['a', 'c'], []),
+                                  'b': (['b', 'c', 'd'], [])})
+
+    def test_shared_dependency_that_fails(self):
+        # The second goal finds 'c' after it has already failed, and its
+        # stratum must not be generated without it.
+        strata = self.run_import(['a', 'b'], {'a': ['c'], 'b': ['c', 'd']},
+                                 failures=['c'])
+
+        self.assertEqual(strata['a'][1], ['c'])
+        self.assertEqual(strata['b'][1], ['c'])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(BatchImportTests)
+    unittest.TextTestRunner(verbosity=2).run(suite)
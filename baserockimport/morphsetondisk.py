@@ -14,9 +14,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import cliapp
 import morphlib
 
+import cPickle
 import copy
+import hashlib
 import logging
 import os
 
@@ -27,41 +30,171 @@ class MorphologySetOnDisk(morphlib.morphset.MorphologySet):
     The base class deals only with reading morphologies into memory. This class
     extends it to support reading and writing them from disk.
 
+    A definitions repo can contain thousands of morphologies, and an import
+    usually only needs a few of them. So only the list of .morph files, and
+    the Git blob SHA1 of each, is read at startup. Each morphology is parsed
+    when it is first asked for. If 'cache_dir' is given, parsed morphologies
+    are also kept there, keyed by blob SHA1, so that files which have not
+    changed do not need parsing again in later runs.
+
     FIXME: this should perhaps be merged into the base class in morphlib.
 
     '''
 
-    def __init__(self, path):
+    def __init__(self, path, cache_dir=None):
         super(MorphologySetOnDisk, self).__init__()
 
         self.path = path
+        self.cache_dir = cache_dir
         self.loader = morphlib.morphloader.MorphologyLoader()
 
+        # Blob SHA1 of each .morph file that hasn't been loaded yet, by
+        # filename relative to self.path.
+        self.unloaded = {}
+
+        # Blob SHA1 of the file that each loaded morphology was read from or
+        # saved to, by filename. See release_morphology().
+        self.loaded = {}
+
         if os.path.exists(path):
-            self.load_all_morphologies()
+            self.unloaded = self._list_morphologies()
         else:
             os.makedirs(path)
             morphlib.gitdir.init(path)
 
-    def load_all_morphologies(self):
-        logging.info('Loading all .morph files under %s', self.path)
+    def _git(self, args):
+        return cliapp.runcmd(['git'] + args, cwd=self.path)
+
+    def _list_morphologies(self):
+        '''Return the blob SHA1 of each .morph file in the working tree.
+
+        Symlinks are ignored.
+
+        '''
+        morphologies = {}
+
+        # Files in the Git index, in the format
+        # '<mode> <sha1> <stage>\t<path>'.
+        output = self._git(['ls-files', '--stage', '-z', '--', '*.morph'])
+        for line in output.split('\0'):
+            if line:
+                info, filename = line.split('\t', 1)
+                mode, sha1, stage = info.split()
+                if mode != '120000':
+                    morphologies[filename] = sha1
+
+        # Files that differ from the index, or aren't in it at all.
+        output = self._git(['ls-files', '--modified', '--others', '-z', '--',
+                            '*.morph'])
+        changed = set(filename for filename in output.split('\0') if filename)
+        for filename in changed:
+            morphologies.pop(filename, None)
+
+        changed = sorted(
+            filename for filename in changed
+            if os.path.isfile(os.path.join(self.path, filename)) and
+            not os.path.islink(os.path.join(self.path, filename)))
+        if len(changed) > 0:
+            output = self._git(['hash-object', '--'] + changed)
+            morphologies.update(zip(changed, output.split()))
+
+        logging.info('Found %i .morph files under %s', len(morphologies),
+                     self.path)
+        return morphologies
+
+    def _cached_morphology_path(self, sha1):
+        return os.path.join(self.cache_dir, '%s.pickle' % sha1)
+
+    def _load_cached_morphology(self, sha1):
+        if self.cache_dir is None:
+            return None
+
+        path = self._cached_morphology_path(sha1)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                return cPickle.load(f)
+        except Exception as e:
+            logging.warning('Ignoring invalid cached morphology %s: %s',
+                            path, e)
+            return None
 
-        gitdir = morphlib.gitdir.GitDirectory(self.path)
-        finder = morphlib.morphologyfinder.MorphologyFinder(gitdir)
-        for filename in (f for f in finder.list_morphologies()
-                         if not gitdir.is_symlink(f)):
-            text = finder.read_morphology(filename)
+    def _cache_morphology(self, sha1, morph):
+        if self.cache_dir is None:
+            return
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        path = self._cached_morphology_path(sha1)
+        with morphlib.savefile.SaveFile(path, 'wb') as f:
+            cPickle.dump(morph, f, cPickle.HIGHEST_PROTOCOL)
+
+    def _load_morphology(self, filename):
+        sha1 = self.unloaded.pop(filename)
+
+        morph = self._load_cached_morphology(sha1)
+        if morph is None:
+            logging.debug('Parsing %s', filename)
+            with open(os.path.join(self.path, filename)) as f:
+                text = f.read()
             morph = self.loader.load_from_string(text, filename=filename)
             morph.repo_url = None  # self.root_repository_url
             morph.ref = None  # self.system_branch_name
-            self.add_morphology(morph)
+            self._cache_morphology(sha1, morph)
+        else:
+            morph.filename = filename
+
+        self.add_morphology(morph)
+        self.loaded[filename] = sha1
+
+    def load_all_morphologies(self):
+        logging.info('Loading all .morph files under %s', self.path)
+
+        for filename in sorted(self.unloaded):
+            self._load_morphology(filename)
 
     def get_morphology(self, repo_url, ref, filename):
+        if filename in self.unloaded:
+            self._load_morphology(filename)
         return self._get_morphology(repo_url, ref, filename)
 
     def save_morphology(self, filename, morphology):
+        # Whatever was on disk or in memory before is about to be replaced.
+        self.unloaded.pop(filename, None)
+        self._forget_morphology(filename)
+
         self.add_morphology(morphology)
         morphology_to_save = copy.copy(morphology)
         self.loader.unset_defaults(morphology_to_save)
-        filename = os.path.join(self.path, filename)
-        self.loader.save_to_file(filename, morphology_to_save)
+        text = self.loader.save_to_string(morphology_to_save)
+        with morphlib.savefile.SaveFile(
+                os.path.join(self.path, filename), 'w') as f:
+            f.write(text)
+
+        # The SHA1 that 'git hash-object' would give the file.
+        self.loaded[filename] = hashlib.sha1(
+            'blob %i\0%s' % (len(text), text)).hexdigest()
+
+    def _forget_morphology(self, filename):
+        '''Remove the loaded morphology 'filename', and return its SHA1.'''
+        sha1 = self.loaded.pop(filename, None)
+        if sha1 is not None:
+            for i, morph in enumerate(self.morphologies):
+                if morph.filename == filename:
+                    del self.morphologies[i]
+                    break
+        return sha1
+
+    def release_morphology(self, filename):
+        '''Forget the loaded morphology 'filename', to free its memory.
+
+        It is read from disk again if it is asked for later, like a
+        morphology that hasn't been loaded yet.
+
+        '''
+        sha1 = self._forget_morphology(filename)
+        if sha1 is not None:
+            self.unloaded[filename] = sha1
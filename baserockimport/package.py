@@ -14,22 +14,82 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+# Large imports create tens of thousands of packages, dependency lists and
+# chunk references, which mostly repeat the same few thousand names and
+# versions. Each distinct string is kept once. The built-in intern() only
+# accepts byte strings, and names read from JSON are unicode.
+_interned_strings = {}
+
+
+def intern_string(value):
+    '''Return the one shared copy of the string 'value'.
+
+    Unicode strings that are plain ASCII, as nearly all package names and
+    versions are, become byte strings, which take less space and are what
+    the rest of the code expects. None is returned unchanged.
+
+    '''
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return _interned_strings.setdefault(value, value)
+
+
+class ChunkReference(object):
+    '''What the stratum needs to know about a package's chunk morphology.
+
+    Once the chunk morphology has been written to disk, only this is kept
+    in memory for the rest of the import.
+
+    '''
+    __slots__ = ('name', 'filename', 'repo_url', 'ref', 'named_ref',
+                 'build_dependencies')
+
+    def __init__(self, morphology):
+        self.name = intern_string(morphology['name'])
+        self.filename = intern_string(morphology.filename)
+        self.repo_url = intern_string(morphology.repo_url)
+        self.ref = morphology.ref
+        self.named_ref = intern_string(morphology.named_ref)
+
+        # The 'x-build-dependencies-KIND' fields, by kind.
+        prefix = 'x-build-dependencies-'
+        self.build_dependencies = dict(
+            (intern_string(field[len(prefix):]),
+             dict((intern_string(name), intern_string(version))
+                  for name, version in morphology[field].iteritems()))
+            for field in morphology.keys() if field.startswith(prefix))
+
+
 class Package(object):
     '''A package in the processing queue.
 
     In order to provide helpful errors, this item keeps track of what
     packages depend on it, and hence of why it was added to the queue.
 
+    There can be a Package for every node of a very large dependency graph,
+    so there are no per-instance dicts and the identifying strings are
+    interned.
+
     '''
+    __slots__ = ('kind', 'name', 'version', 'required_by', 'morphology',
+                 'dependencies', 'is_build_dep', 'version_in_use')
+
     def __init__(self, kind, name, version):
-        self.kind = kind
-        self.name = name
-        self.version = version
+        self.kind = intern_string(kind)
+        self.name = intern_string(name)
+        self.version = intern_string(version)
+
+        # The Package objects that depend on this one, each listed once.
         self.required_by = []
         self.morphology = None
         self.dependencies = None
         self.is_build_dep = False
-        self.version_in_use = version
+        self.version_in_use = self.version
 
     def __cmp__(self, other):
         return cmp(self.name, other.name)
@@ -39,14 +99,24 @@ class Package(object):
 
     def __str__(self):
         if len(self.required_by) > 0:
-            required_msg = ', '.join(self.required_by)
+            required_msg = ', '.join(
+                '%s-%s' % (item.name, item.version)
+                for item in self.required_by)
             required_msg = ', required by: ' + required_msg
         else:
             required_msg = ''
         return '%s-%s%s' % (self.name, self.version, required_msg)
 
+    @property
+    def key(self):
+        '''The (kind, name, version) tuple that identifies this package.'''
+        return (self.kind, self.name, self.version)
+
     def add_required_by(self, item):
-        self.required_by.append('%s-%s' % (item.name, item.version))
+        # All of the dependencies of 'item' are added at once, so if it is
+        # here already it is the last entry.
+        if len(self.required_by) == 0 or self.required_by[-1] is not item:
+            self.required_by.append(item)
 
     def match(self, kind, name, version):
         return (self.kind == kind and
@@ -58,7 +128,12 @@ class Package(object):
     # mutable and some of the state is not ...
 
     def set_morphology(self, morphology):
-        self.morphology = morphology
+        '''Record the chunk morphology of this package.
+
+        Only a ChunkReference to it is kept, so it can be freed.
+
+        '''
+        self.morphology = ChunkReference(morphology)
 
     def set_dependencies(self, dependencies):
         self.dependencies = dependencies
@@ -67,4 +142,53 @@ class Package(object):
         self.is_build_dep = is_build_dep
 
     def set_version_in_use(self, version_in_use):
-        self.version_in_use = version_in_use
+        self.version_in_use = intern_string(version_in_use)
+
+
+class PackageRegistry(object):
+    '''The set of all Package objects known to an import, keyed by identity.
+
+    A package is identified by its (kind, name, version) tuple. Looking a
+    package up by key takes constant time, however many packages there are,
+    which matters when the dependency graph has thousands of nodes.
+
+    '''
+    def __init__(self):
+        self._packages = {}
+        self._by_name = {}
+
+    def __contains__(self, package):
+        return self._packages.get(package.key) is package
+
+    def __iter__(self):
+        return self._packages.itervalues()
+
+    def __len__(self):
+        return len(self._packages)
+
+    def add(self, package):
+        '''Add 'package' to the registry.
+
+        It is an error to add two packages with the same key.
+
+        '''
+        assert package.key not in self._packages
+        self._packages[package.key] = package
+        self._by_name.setdefault(
+            (package.kind, package.name), []).append(package)
+
+    def get(self, kind, name, version):
+        '''Return the Package matching kind, name and version, or None.'''
+        return self._packages.get((kind, name, version))
+
+    def find(self, kind, name):
+        '''Return every Package of project 'name', whatever its version.'''
+        return list(self._by_name.get((kind, name), []))
+
+    def set_version(self, package, version):
+        '''Change the version of 'package', which changes its key.'''
+        assert (package.kind, package.name, version) not in self._packages
+        del self._packages[package.key]
+        package.version = intern_string(version)
+        package.version_in_use = package.version
+        self._packages[package.key] = package
@@ -0,0 +1,246 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import morphlib
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+
+# Linux can report the CPU time of the calling thread alone, which is what we
+# want when several packages are processed at once. Python 2 doesn't define
+# the constant.
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+
+def thread_cpu_time():
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def children_cpu_time():
+    times = os.times()
+    return times[2] + times[3]
+
+
+def peak_memory_usage():
+    '''Return the peak resident set size of this process so far, in KiB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Phase(object):
+    '''One timed phase of an import, such as running an extension.'''
+
+    def __init__(self, package, name, thread, depth):
+        self.package = package
+        self.name = name
+        self.thread = thread
+        self.depth = depth
+        self.start = None
+        self.wall = None
+        self.cpu = None
+        self.children = None
+        self.maxrss = None
+        self.has_nested_phases = False
+
+    def as_dict(self):
+        return {
+            'package': self.package,
+            'phase': self.name,
+            'thread': self.thread,
+            'depth': self.depth,
+            'start': self.start,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'subprocess': self.children,
+            'maxrss': self.maxrss,
+        }
+
+
+class NullProfiler(object):
+    '''A profiler that records nothing, used when profiling is disabled.'''
+
+    @contextlib.contextmanager
+    def phase(self, package, name):
+        yield
+
+    def write_report(self, path):
+        pass
+
+    def write_trace(self, path):
+        pass
+
+    def summary(self, top):
+        return []
+
+    def phases(self):
+        return []
+
+
+class ImportProfiler(NullProfiler):
+    '''Record how long each phase of processing each package takes.
+
+    For each phase three times are recorded: wall clock time, CPU time of
+    the thread that ran it, and CPU time of the subprocesses that finished
+    while it ran, such as Lorry, Git and import extensions. The peak memory
+    usage of the import process when the phase ended is recorded too. Phases
+    can be nested, for example running Lorry while fetching a package's
+    source.
+
+    Subprocess time is counted for the whole import process, so when
+    packages are processed by several threads at once (see the 'jobs'
+    setting) it can be attributed to the wrong phase. Extensions that run as
+    persistent workers don't finish during a phase, so their time is only
+    included in the wall clock time.
+
+    '''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self._phases = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_numbers = {}
+
+    def _thread_number(self):
+        # Small numbers are easier to read in a trace viewer than thread
+        # identifiers.
+        ident = threading.current_thread().ident
+        with self._lock:
+            if ident not in self._thread_numbers:
+                self._thread_numbers[ident] = len(self._thread_numbers)
+            return self._thread_numbers[ident]
+
+    @contextlib.contextmanager
+    def phase(self, package, name):
+        '''Time the code run in a 'with' block.
+
+        'package' is a description of the package being processed, or None
+        for phases that aren't for any single package. A nested phase is for
+        the same package as the phase around it, unless 'package' is given.
+
+        '''
+        outer = getattr(self._local, 'phases', [])
+        if len(outer) > 0:
+            outer[-1].has_nested_phases = True
+            if package is None:
+                package = outer[-1].package
+        depth = len(outer)
+        phase = Phase(package, name, self._thread_number(), depth)
+
+        self._local.phases = outer + [phase]
+        start_cpu = thread_cpu_time()
+        start_children = children_cpu_time()
+        phase.start = time.time() - self.start_time
+        try:
+            yield
+        finally:
+            phase.wall = time.time() - self.start_time - phase.start
+            phase.cpu = thread_cpu_time() - start_cpu
+            phase.children = children_cpu_time() - start_children
+            phase.maxrss = peak_memory_usage()
+            self._local.phases = outer
+            with self._lock:
+                self._phases.append(phase)
+
+    def phases(self):
+        with self._lock:
+            return list(self._phases)
+
+    def write_report(self, path):
+        '''Write every recorded phase to 'path' as JSON.'''
+        report = {
+            'duration': time.time() - self.start_time,
+            'phases': [phase.as_dict() for phase in self.phases()],
+        }
+        with morphlib.savefile.SaveFile(path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    def write_trace(self, path):
+        '''Write the phases to 'path' as a Chrome trace-event file.
+
+        This can be loaded into chrome://tracing, or another viewer for the
+        Trace Event Format, to show what each thread did when.
+
+        '''
+        pid = os.getpid()
+        events = []
+        for phase in self.phases():
+            events.append({
+                'name': phase.name,
+                'cat': 'import',
+                'ph': 'X',
+                'pid': pid,
+                'tid': phase.thread,
+                'ts': int(phase.start * 1000000),
+                'dur': int(phase.wall * 1000000),
+                'args': {
+                    'package': phase.package,
+                    'cpu': phase.cpu,
+                    'subprocess': phase.children,
+                    'maxrss': phase.maxrss,
+                },
+            })
+        with morphlib.savefile.SaveFile(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self, top):
+        '''Return lines describing the 'top' slowest phases and packages.
+
+        Package totals only include phases that aren't nested in another
+        one, so no time is counted twice. The slowest phases are chosen from
+        those that have no phases nested in them, which say most about where
+        the time went.
+
+        '''
+        phases = self.phases()
+
+        by_package = collections.defaultdict(float)
+        by_name = collections.defaultdict(float)
+        for phase in phases:
+            if phase.depth == 0:
+                by_package[phase.package or '(whole import)'] += phase.wall
+            by_name[phase.name] += phase.wall
+
+        lines = ['Slowest packages:']
+        for package, wall in sorted(by_package.iteritems(),
+                                    key=lambda (p, w): (-w, p))[:top]:
+            lines.append('  %8.2fs  %s' % (wall, package))
+
+        lines.append('Slowest phases:')
+        lines.append('  %9s %9s %9s  %s' % ('wall', 'cpu', 'subproc',
+                                            'phase'))
+        innermost = [p for p in phases if not p.has_nested_phases]
+        slowest = sorted(innermost, key=lambda p: -p.wall)[:top]
+        for phase in slowest:
+            lines.append('  %8.2fs %8.2fs %8.2fs  %s%s' % (
+                phase.wall, phase.cpu, phase.children, phase.name,
+                ' (%s)' % phase.package if phase.package else ''))
+
+        lines.append('Total time in each phase:')
+        for name, wall in sorted(by_name.iteritems(),
+                                 key=lambda (n, w): (-w, n)):
+            lines.append('  %8.2fs  %s' % (wall, name))
+
+        return lines
@@ -0,0 +1,105 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import morphlib
+
+import hashlib
+import json
+import logging
+import os
+
+
+class ResultCache(object):
+    '''Content-addressed cache of the output of import extensions.
+
+    The output of an extension such as python.to_chunk or rubygems.to_chunk
+    depends only on the extension itself, the arguments it is given and the
+    source tree it looks at. So the output is stored under a key made from
+    the extension's code, the commit SHA1 of the source tree and the other
+    arguments, and can be reused whenever the same source tree is seen again:
+    under a different goal stratum, in a later run or on another machine.
+
+    The cache is a plain directory of files, which can be shared between
+    machines. Entries are written atomically and never modified, so several
+    imports can use the same cache directory at once.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.script_hashes = {}
+
+    def _script_hash(self, script_path):
+        '''Return a hash of an extension and the shared code it uses.
+
+        The 'importer_*' files in the extensions directory are libraries
+        which are shared between extensions, so they are included.
+
+        '''
+        if script_path not in self.script_hashes:
+            exts_dir = os.path.dirname(script_path)
+            shared = sorted(f for f in os.listdir(exts_dir)
+                            if f.startswith('importer_'))
+
+            sha = hashlib.sha1()
+            for filename in [os.path.basename(script_path)] + shared:
+                with open(os.path.join(exts_dir, filename), 'rb') as f:
+                    sha.update(filename + '\0' + f.read() + '\0')
+            self.script_hashes[script_path] = sha.hexdigest()
+        return self.script_hashes[script_path]
+
+    def key(self, script_path, commit, args):
+        '''Return the cache key for running an extension on a commit.
+
+        'args' should be every argument to the extension apart from the path
+        to the source tree.
+
+        '''
+        description = json.dumps(
+            [self._script_hash(script_path), os.path.basename(script_path),
+             commit, args])
+        return hashlib.sha1(description).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], '%s.json' % key)
+
+    def get(self, key):
+        '''Return the cached output for 'key', or None.'''
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path) as f:
+                return json.load(f)['output']
+        except (ValueError, KeyError) as e:
+            logging.warning('Ignoring invalid result cache entry %s: %s',
+                            path, e)
+            return None
+
+    def put(self, key, output):
+        path = self._entry_path(key)
+        entry_dir = os.path.dirname(path)
+        if not os.path.exists(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                # Another import may have created it at the same time.
+                if not os.path.isdir(entry_dir):
+                    raise
+
+        with morphlib.savefile.SaveFile(path, 'w') as f:
+            json.dump({'output': output}, f)
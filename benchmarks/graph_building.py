@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# Benchmark for building the dependency graph in the Baserock Import tool.
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Time ImportLoop's queue and graph handling on synthetic dependency graphs.
+
+No packages are fetched or analysed: each package is given a precomputed
+list of dependencies, and only the bookkeeping that the main loop does
+between packages is measured. If the bookkeeping scales linearly, the
+'per package' column should stay roughly constant as the graph grows.
+
+Each package is also given a chunk morphology, as _process_package() would,
+and the memory that the import holds on to once the graph is built is
+measured. Each size is run in a new process, so that memory freed by one
+doesn't hide what the next one needs. The 'ordering' column is the time
+taken to group the chunks into build levels for the stratum.
+
+Run from the top of the source tree:
+
+    python benchmarks/graph_building.py [SIZE ...]
+
+'''
+
+
+import morphlib
+import networkx
+
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import baserockimport
+
+
+DEFAULT_SIZES = [1000, 2500, 5000, 10000]
+
+
+class BenchmarkApp(object):
+    '''Just enough of BaserockImportApplication for ImportLoop to run.'''
+
+    def __init__(self, tempdir):
+        self.settings = {
+            'lorries-dir': os.path.join(tempdir, 'lorries'),
+            'definitions-dir': os.path.join(tempdir, 'definitions'),
+            'cache-dir': os.path.join(tempdir, 'cache'),
+            'result-cache': False,
+            'result-cache-dir': '',
+            'pypi-cache-ttl': 0,
+            'rubygems-cache-ttl': 0,
+            'pypi-index': '',
+            'python-resolution': 'per-package',
+            'profile-dir': '',
+            'persistent-extensions': False,
+            'update-existing': False,
+            'jobs': 1,
+            'fetch-jobs': 0,
+            'analysis-jobs': 0,
+        }
+
+    def status(self, msg, *args, **kwargs):
+        pass
+
+
+def synthetic_dependencies(size, seed=0, runtime_fanout=4, build_fanout=1):
+    '''Return a dependency dict for each of 'size' packages.
+
+    Package N only depends on packages with a higher number, so the graph is
+    acyclic, like a real build graph needs to be. Package N always depends on
+    package N+1, so every package is reachable from the goal.
+
+    '''
+    rng = random.Random(seed)
+
+    def pick(n, i):
+        candidates = xrange(i + 1, size)
+        return rng.sample(candidates, min(n, len(candidates)))
+
+    result = []
+    for i in xrange(size):
+        build_deps = dict(('pkg-%i' % j, '1.0') for j in pick(build_fanout, i))
+        runtime_deps = dict(
+            ('pkg-%i' % j, '1.0') for j in pick(runtime_fanout, i))
+        if i + 1 < size:
+            runtime_deps['pkg-%i' % (i + 1)] = '1.0'
+        result.append({
+            'synthetic': {
+                'build-dependencies': build_deps,
+                'runtime-dependencies': runtime_deps,
+            }
+        })
+    return result
+
+
+def synthetic_morphology(package, dependencies):
+    '''Return a chunk morphology like python.to_chunk generates.'''
+    morphology = morphlib.morphology.Morphology({
+        'name': package.name,
+        'kind': 'chunk',
+        'build-system': 'python-distutils',
+    })
+    for kind, kind_deps in dependencies.iteritems():
+        morphology['x-build-dependencies-%s' % kind] = dict(
+            kind_deps['build-dependencies'])
+        morphology['x-runtime-dependencies-%s' % kind] = dict(
+            kind_deps['runtime-dependencies'])
+    morphology.filename = 'strata/pkg-0/%s-%s.morph' % (package.name,
+                                                         package.version)
+    morphology.repo_url = 'upstream:python-packages/%s' % package.name
+    morphology.ref = '0' * 40
+    morphology.named_ref = package.version
+    return morphology
+
+
+def resident_memory():
+    '''Return the resident set size of this process now, in bytes.'''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def build_graph(loop, dependencies):
+    goal = baserockimport.package.Package('synthetic', 'pkg-0', '1.0')
+    loop.packages.add(goal)
+
+    to_process = [goal]
+    processed = networkx.DiGraph()
+    errors = {}
+
+    while len(to_process) > 0:
+        package = to_process.pop()
+        index = int(package.name.split('-')[1])
+        package.set_dependencies(dependencies[index])
+        package.set_morphology(
+            synthetic_morphology(package, dependencies[index]))
+        loop._update_queue_and_graph(
+            package, package.dependencies, to_process, processed, errors)
+
+    return processed
+
+
+def run_benchmark(size):
+    tempdir = tempfile.mkdtemp()
+    try:
+        loop = baserockimport.mainloop.ImportLoop(
+            BenchmarkApp(tempdir), 'synthetic', 'pkg-0', '1.0')
+        dependencies = synthetic_dependencies(size)
+
+        start_memory = resident_memory()
+        start_time = time.time()
+        graph = build_graph(loop, dependencies)
+        duration = time.time() - start_time
+        memory = resident_memory() - start_memory
+
+        start_time = time.time()
+        loop._build_levels(graph)
+        ordering = time.time() - start_time
+    finally:
+        shutil.rmtree(tempdir)
+
+    return {
+        'nodes': graph.number_of_nodes(),
+        'edges': graph.number_of_edges(),
+        'duration': duration,
+        'memory': memory,
+        'ordering': ordering,
+    }
+
+
+def main():
+    if sys.argv[1:2] == ['--run-one']:
+        print json.dumps(run_benchmark(int(sys.argv[2])))
+        return
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+
+    print '%8s %8s %10s %16s %10s %12s %10s' % (
+        'nodes', 'edges', 'seconds', 'per package', 'memory', 'per package',
+        'ordering')
+    for size in sizes:
+        result = json.loads(subprocess.check_output(
+            [sys.executable, __file__, '--run-one', str(size)]))
+        print '%8i %8i %10.3f %14.1fus %8.1fMiB %10.0fB %9.3fs' % (
+            result['nodes'], result['edges'], result['duration'],
+            result['duration'] / size * 1e6,
+            result['memory'] / 1024.0 / 1024.0,
+            float(result['memory']) / size, result['ordering'])
+
+
+if __name__ == '__main__':
+    main()
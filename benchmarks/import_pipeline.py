@@ -0,0 +1,365 @@
+#!/usr/bin/python
+# End-to-end benchmark for the Baserock Import tool, using local fixtures.
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Time a whole Python import on synthetic packages, without a network.
+
+For each size, these fixtures are generated:
+
+  - a bare Git repo for each package, tagged with its version, containing a
+    setup.py and a setup.cfg that lists its requirements. One package in ten
+    lists its runtime requirements in setup.py instead, so that they have to
+    be found with pip rather than read statically;
+  - a local package index (see --pypi-index in README.python) whose home
+    page links point at the repos;
+  - stub 'lorry' and 'pip' programs, which mirror the repos with plain Git
+    and report the requirements listed in a source tree.
+
+The dependency graph is the one that graph_building.py uses. ImportLoop is
+then run on the first package, with the real python extensions, in a new
+process so that its peak memory usage isn't affected by earlier runs. The
+time spent in each stage comes from its profiler (see --profile-dir in the
+README), along with the peak memory usage of the import process when the
+stage last finished.
+
+RubyGems and Omnibus imports need Ruby and Bundler, and their extensions
+have no offline mode, so they aren't covered.
+
+Run from the top of the source tree:
+
+    python benchmarks/import_pipeline.py [--jobs N] [--fetch-jobs N]
+        [--analysis-jobs N] [--persistent-extensions] [--fixtures-dir DIR]
+        [SIZE ...]
+
+Generating the fixtures for 10000 packages takes a few minutes, so with
+--fixtures-dir they are kept and reused by later runs.
+
+'''
+
+
+import argparse
+import collections
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import baserockimport
+
+from graph_building import synthetic_dependencies
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+VERSION = '1.0'
+
+# Every package in this many lists its runtime requirements in setup.py.
+PIP_EVERY = 10
+
+
+STUB_LORRY = '''#!%(python)s
+# Mirror git repos the way Lorry does, using plain Git.
+import json, os, subprocess, sys
+args = sys.argv[1:]
+working_area = args[args.index('--working-area') + 1]
+with open(args[-1]) as f:
+    lorries = json.load(f)
+for name, entry in sorted(lorries.items()):
+    path = os.path.join(working_area, name.replace('/', '_'), 'git')
+    if os.path.exists(path):
+        subprocess.check_call(['git', '--git-dir', path, 'fetch', '-q',
+                               entry['url'], '+refs/*:refs/*'])
+    else:
+        subprocess.check_call(['git', 'clone', '-q', '--mirror',
+                               entry['url'], path])
+'''
+
+STUB_PIP = '''#!%(python)s
+# Report the requirements in requirements.in, like the patched pip that
+# python.find_deps uses does.
+import sys
+for arg in sys.argv[1:]:
+    if arg.startswith('--list-dependencies='):
+        with open('requirements.in') as f:
+            requirements = f.read()
+        with open(arg.split('=', 1)[1], 'w') as f:
+            f.write(requirements)
+'''
+
+
+def package_name(index):
+    return 'pkg-%i' % index
+
+
+def package_files(index, dependencies):
+    deps = dependencies[index]['synthetic']
+    build = sorted('%s>=%s' % (name, VERSION)
+                   for name in deps['build-dependencies'])
+    runtime = sorted('%s>=%s' % (name, VERSION)
+                     for name in deps['runtime-dependencies'])
+
+    def option(name, requirements):
+        return '%s =\n%s\n' % (
+            name, ''.join('    %s\n' % r for r in requirements))
+
+    setup_cfg = ('[metadata]\nname = %s\nversion = %s\n\n[options]\n' %
+                 (package_name(index), VERSION))
+    setup_cfg += option('setup_requires', build)
+
+    files = {}
+    if index % PIP_EVERY == PIP_EVERY - 1:
+        files['setup.py'] = (
+            'from setuptools import setup\n'
+            'setup(install_requires=open("requirements.in").readlines())\n')
+        files['requirements.in'] = ''.join('%s\n' % r for r in runtime)
+    else:
+        files['setup.py'] = 'from setuptools import setup\nsetup()\n'
+        setup_cfg += option('install_requires', runtime)
+    files['setup.cfg'] = setup_cfg
+    return files
+
+
+def create_repo(path, files):
+    '''Create a bare repo with one commit of 'files', tagged VERSION.'''
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+
+    stream = []
+    for mark, name in enumerate(sorted(files), 1):
+        content = files[name]
+        stream.append('blob\nmark :%i\ndata %i\n%s\n' %
+                      (mark, len(content), content))
+    message = 'Synthetic package\n'
+    stream.append(
+        'commit refs/heads/master\n'
+        'author Benchmark <benchmark@example.com> 0 +0000\n'
+        'committer Benchmark <benchmark@example.com> 0 +0000\n'
+        'data %i\n%s' % (len(message), message))
+    for mark, name in enumerate(sorted(files), 1):
+        stream.append('M 100644 :%i %s\n' % (mark, name))
+    stream.append('\nreset refs/tags/%s\nfrom refs/heads/master\n\n' %
+                  VERSION)
+
+    p = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                         stdin=subprocess.PIPE)
+    p.communicate(''.join(stream))
+    if p.returncode != 0:
+        raise Exception('git fast-import failed in %s' % path)
+
+
+def write_stub(path, template):
+    with open(path, 'w') as f:
+        f.write(template % {'python': sys.executable})
+    os.chmod(path, 0755)
+
+
+def generate_fixtures(path, size):
+    '''Create the fixtures for 'size' packages in 'path'.'''
+    dependencies = synthetic_dependencies(size)
+
+    repos_dir = os.path.join(path, 'repos')
+    os.makedirs(repos_dir)
+    index = {}
+    for i in xrange(size):
+        name = package_name(i)
+        repo = os.path.join(repos_dir, name)
+        create_repo(repo, package_files(i, dependencies))
+        index[name] = {
+            'info': {'name': name, 'home_page': 'file://%s' % repo},
+            'releases': {VERSION: []},
+        }
+
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    bin_dir = os.path.join(path, 'bin')
+    os.makedirs(bin_dir)
+    write_stub(os.path.join(bin_dir, 'lorry'), STUB_LORRY)
+    write_stub(os.path.join(bin_dir, 'pip'), STUB_PIP)
+    # The extensions and python.find_deps run 'python', which should be the
+    # interpreter that this benchmark runs in.
+    os.symlink(sys.executable, os.path.join(bin_dir, 'python'))
+
+    with open(os.path.join(path, 'complete'), 'w') as f:
+        f.write('%i\n' % size)
+
+
+class BenchmarkApp(object):
+    '''Just enough of BaserockImportApplication for ImportLoop to run.'''
+
+    def __init__(self, fixtures_dir, work_dir, jobs, persistent_extensions):
+        # 'jobs' is a (jobs, fetch jobs, analysis jobs) triple.
+        self.settings = {
+            'lorries-dir': os.path.join(work_dir, 'lorries'),
+            'definitions-dir': os.path.join(work_dir, 'definitions'),
+            'checkouts-dir': os.path.join(work_dir, 'checkouts'),
+            'lorry-working-dir': os.path.join(work_dir, 'lorry-working-dir'),
+            'cache-dir': os.path.join(work_dir, 'cache'),
+            'result-cache': False,
+            'result-cache-dir': '',
+            'force-stratum-generation': False,
+            'update-existing': False,
+            'incremental': False,
+            'use-local-sources': False,
+            'use-master-if-no-tag': False,
+            'jobs': jobs[0],
+            'fetch-jobs': jobs[1],
+            'analysis-jobs': jobs[2],
+            'pypi-cache-ttl': 24 * 60 * 60,
+            'rubygems-cache-ttl': 24 * 60 * 60,
+            'pypi-index': os.path.join(fixtures_dir, 'index.json'),
+            'python-resolution': 'per-package',
+            'persistent-extensions': persistent_extensions,
+            'checkout-mode': 'clone',
+            'fetch-max-age': 24 * 60 * 60,
+            'checkpoint-interval': 60,
+            'resume': False,
+            'profile-dir': os.path.join(work_dir, 'profile'),
+            'profile-top': 10,
+        }
+        self.errors = []
+
+    def status(self, msg, *args, **kwargs):
+        if kwargs.get('error'):
+            self.errors.append(msg % args)
+
+
+def run_import(fixtures_dir, work_dir, jobs, persistent_extensions,
+               result_path):
+    '''Import the first package, and write the measurements to a file.'''
+    os.environ['PATH'] = '%s:%s' % (os.path.join(fixtures_dir, 'bin'),
+                                    os.environ['PATH'])
+    os.makedirs(work_dir)
+
+    app = BenchmarkApp(fixtures_dir, work_dir, jobs, persistent_extensions)
+    start_time = time.time()
+    loop = baserockimport.mainloop.ImportLoop(
+        app, 'python', package_name(0), VERSION)
+    loop.enable_importer('python', strata=['strata/core.morph'])
+    loop.run()
+    duration = time.time() - start_time
+
+    with open(result_path, 'w') as f:
+        json.dump({
+            'duration': duration,
+            'packages': len(loop.packages),
+            'errors': app.errors,
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children-maxrss':
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'phases': [phase.as_dict() for phase in loop.profiler.phases()],
+        }, f)
+
+
+def report(size, setup_time, result):
+    print '%i packages (%i imported, %i errors): %.1fs, plus %.1fs to ' \
+          'generate fixtures' % (size, result['packages'],
+                                 len(result['errors']), result['duration'],
+                                 setup_time)
+    print 'Peak memory: %.1f MiB in the import, %.1f MiB in the largest ' \
+          'subprocess' % (result['maxrss'] / 1024.0,
+                          result['children-maxrss'] / 1024.0)
+    for error in result['errors'][:5]:
+        print '  error: %s' % error
+
+    stages = collections.OrderedDict()
+    for phase in sorted(result['phases'], key=lambda p: p['start']):
+        stage = stages.setdefault(phase['phase'], {
+            'count': 0, 'wall': 0.0, 'cpu': 0.0, 'subprocess': 0.0,
+            'maxrss': 0})
+        stage['count'] += 1
+        for field in ['wall', 'cpu', 'subprocess']:
+            stage[field] += phase[field]
+        stage['maxrss'] = max(stage['maxrss'], phase['maxrss'])
+
+    print '  %-20s %7s %9s %9s %9s %10s' % (
+        'stage', 'count', 'wall', 'cpu', 'subproc', 'peak RSS')
+    for name, stage in stages.iteritems():
+        print '  %-20s %7i %8.2fs %8.2fs %8.2fs %7.1fMiB' % (
+            name, stage['count'], stage['wall'], stage['cpu'],
+            stage['subprocess'], stage['maxrss'] / 1024.0)
+    print
+
+
+def run_benchmark(size, fixtures_root, jobs, persistent_extensions):
+    tempdir = tempfile.mkdtemp()
+    try:
+        if fixtures_root:
+            fixtures_dir = os.path.join(
+                os.path.abspath(fixtures_root), 'size-%i' % size)
+        else:
+            fixtures_dir = os.path.join(tempdir, 'fixtures')
+
+        setup_time = 0
+        if not os.path.exists(os.path.join(fixtures_dir, 'complete')):
+            if os.path.exists(fixtures_dir):
+                shutil.rmtree(fixtures_dir)
+            start_time = time.time()
+            generate_fixtures(fixtures_dir, size)
+            setup_time = time.time() - start_time
+
+        result_path = os.path.join(tempdir, 'result.json')
+        args = [sys.executable, __file__, '--run-import', fixtures_dir,
+                os.path.join(tempdir, 'work'), result_path,
+                '--jobs', str(jobs[0]), '--fetch-jobs', str(jobs[1]),
+                '--analysis-jobs', str(jobs[2])]
+        if persistent_extensions:
+            args.append('--persistent-extensions')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(args, stdout=devnull)
+
+        with open(result_path) as f:
+            report(size, setup_time, json.load(f))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time a whole import of synthetic Python packages.')
+    parser.add_argument('sizes', metavar='SIZE', type=int, nargs='*',
+                        default=DEFAULT_SIZES)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--fetch-jobs', type=int, default=0)
+    parser.add_argument('--analysis-jobs', type=int, default=0)
+    parser.add_argument('--persistent-extensions', action='store_true')
+    parser.add_argument('--fixtures-dir',
+                        help='keep the fixtures in DIR and reuse them')
+    parser.add_argument('--run-import', nargs=3,
+                        metavar=('FIXTURES', 'WORKDIR', 'RESULT'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    jobs = (args.jobs, args.fetch_jobs, args.analysis_jobs)
+
+    if args.run_import:
+        fixtures_dir, work_dir, result_path = args.run_import
+        run_import(fixtures_dir, work_dir, jobs,
+                   args.persistent_extensions, result_path)
+    else:
+        for size in args.sizes:
+            run_benchmark(size, args.fixtures_dir, jobs,
+                          args.persistent_extensions)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# Benchmark for the version constraint solver in python.find_deps.
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Time resolve_specs() and resolve_versions() used by python.find_deps.
+
+resolve_specs() is run on every pair of specs that ConflictDetectionTests in
+python_find_deps_tests.py covers, and on long requirement lists. Each is
+compared with checking every spec against every other one, which is how
+conflicts used to be found.
+
+resolve_versions() is run against a fake package index with many releases
+per project, and compared with testing every release against every spec.
+
+Run from the top of the source tree:
+
+    python benchmarks/version_solver.py [RELEASES ...]
+
+'''
+
+
+import imp
+import itertools
+import logging
+import os
+import random
+import sys
+import time
+
+exts_dir = os.path.join(os.path.dirname(__file__), '..', 'baserockimport',
+                        'exts')
+sys.path.insert(0, exts_dir)
+
+import pkg_resources
+
+import importer_python_common
+python_find_deps = imp.load_source(
+    'python_find_deps', os.path.join(exts_dir, 'python.find_deps'))
+
+
+DEFAULT_RELEASE_COUNTS = [10, 100, 1000]
+
+OPS = ['==', '!=', '<', '>', '<=', '>=']
+
+
+class FakeClient(object):
+    def __init__(self, releases):
+        self.releases = releases
+
+    def canonical_name(self, name):
+        return name
+
+    def package_releases(self, name):
+        return self.releases
+
+
+def pairwise_resolve_specs(requirements):
+    '''Find conflicts by checking every pair of specs, as before.'''
+    requirements = list(requirements)
+    logging.debug('Resolving specs from the following requirements: %s'
+                  % requirements)
+    specsets = {}
+    for r in requirements:
+        specset = specsets.setdefault(r.project_name, set())
+        for (op, version) in r.specs:
+            spec = (op, pkg_resources.parse_version(version))
+            if python_find_deps.conflict_with_set(spec, specset):
+                raise python_find_deps.ConflictError(r.project_name, spec,
+                                                     spec)
+            specset.add(spec)
+    return specsets
+
+
+def linear_resolve_versions(client, specsets):
+    '''Test every release against every spec, as before.'''
+    versions = {}
+    for (proj_name, specset) in specsets.iteritems():
+        releases = client.package_releases(proj_name)
+        versions[proj_name] = [
+            v for v in releases
+            if python_find_deps.specs_satisfied(
+                pkg_resources.parse_version(v), specset)]
+    return versions
+
+
+def time_calls(function, args_list, repeat):
+    start_time = time.time()
+    for _ in xrange(repeat):
+        for args in args_list:
+            try:
+                function(*args)
+            except python_find_deps.ConflictError:
+                pass
+    return time.time() - start_time
+
+
+def conflict_test_cases():
+    '''Every pair of specs that ConflictDetectionTests exercises.'''
+    cases = []
+    for (vx, vy) in [('0.1', '0.1'), ('0.1', '0.2'), ('0.2', '0.1')]:
+        for (opx, opy) in itertools.product(OPS, OPS):
+            cases.append(list(pkg_resources.parse_requirements(
+                ['a %s %s' % (opx, vx), 'a %s %s' % (opy, vy)])))
+    return cases
+
+
+def long_requirement_lists(count, length, seed=0):
+    '''Lists of 'length' compatible specs on one project.'''
+    rng = random.Random(seed)
+    cases = []
+    for _ in xrange(count):
+        specs = []
+        for i in xrange(length):
+            op = rng.choice(['!=', '<', '<=', '>', '>='])
+            if op in ('<', '<='):
+                version = '%i.%i' % (100 + i, rng.randint(0, 9))
+            elif op in ('>', '>='):
+                version = '0.%i' % i
+            else:
+                version = '50.%i' % i
+            specs.append('a %s %s' % (op, version))
+        cases.append(list(pkg_resources.parse_requirements(specs)))
+    return cases
+
+
+def benchmark_resolve_specs():
+    print 'resolve_specs()'
+    print '%24s %12s %12s' % ('case', 'pairwise', 'intervals')
+
+    for (description, cases, repeat) in [
+            ('test case pairs', conflict_test_cases(), 200),
+            ('10 specs', long_requirement_lists(100, 10), 20),
+            ('100 specs', long_requirement_lists(10, 100), 2)]:
+        before = time_calls(pairwise_resolve_specs,
+                            [(c,) for c in cases], repeat)
+        after = time_calls(python_find_deps.resolve_specs,
+                           [(c,) for c in cases], repeat)
+        print '%24s %11.3fs %11.3fs' % (description, before, after)
+
+
+def benchmark_resolve_versions(release_counts):
+    print
+    print 'resolve_versions()'
+    print '%24s %12s %12s' % ('releases', 'linear', 'bisection')
+
+    requirements = list(pkg_resources.parse_requirements(
+        ['a >= 1.0', 'a < 5.0', 'a != 2.5']))
+    specsets = python_find_deps.resolve_specs(requirements)
+
+    for count in release_counts:
+        releases = ['%.4f' % (i * 10.0 / count) for i in xrange(count)]
+        client = FakeClient(releases)
+        importer_python_common.get_pypi_client = lambda: client
+        importer_python_common._sorted_releases.clear()
+
+        repeat = 100
+        before = time_calls(linear_resolve_versions, [(client, specsets)],
+                            repeat)
+        # The first call parses the releases, the others reuse them.
+        after = time_calls(python_find_deps.resolve_versions, [(specsets,)],
+                           repeat)
+        print '%24i %11.3fs %11.3fs' % (count, before, after)
+
+
+def main():
+    release_counts = ([int(arg) for arg in sys.argv[1:]] or
+                      DEFAULT_RELEASE_COUNTS)
+
+    benchmark_resolve_specs()
+    benchmark_resolve_versions(release_counts)
+
+
+if __name__ == '__main__':
+    main()